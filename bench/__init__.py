@@ -0,0 +1,6 @@
+"""
+Benchmarks of fortdep and fortdep2 on synthetic Fortran trees.
+
+    python -m bench.generate --files 10000 tree10k
+    python -m bench.run --sizes 1000,10000 --json results.json
+"""
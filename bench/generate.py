@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Deterministic generator of synthetic Fortran trees. Modules are arranged
+in layers (depth of the DAG), each using fanout modules of lower layers.
+Some files are submodules of earlier modules, some modules include files,
+and programs use modules of the top layer. The same parameters always
+give the same tree.
+
+    python -m bench.generate --files 10000 --fanout 4 tree10k
+"""
+
+from os import path, makedirs
+from bisect import bisect_left
+import random
+
+# files in one directory
+files_per_dir = 100
+
+def generate(root, files = 1000, modules_per_file = 1, fanout = 3, depth = 10,
+        submodules = 0.1, includes = 0.05, programs = 10, lines = 20, seed = 1):
+    """
+    Write a tree of given number of source files (programs not counted) to
+    root. Returns a summary: numbers of files, modules and bytes written.
+    """
+    rnd = random.Random(seed)
+    summary = dict(files = 0, modules = 0, submodules = 0, programs = 0,
+        includes = 0, bytes = 0)
+
+    def write(relpath, text):
+        fn = path.join(root, relpath)
+        makedirs(path.dirname(fn), exist_ok = True)
+        with open(fn, 'w') as f:
+            f.write(text)
+        summary['bytes'] += len(text)
+
+    def body(name):
+        # filler, so that files have a realistic size
+        out = [ 'contains\n', '  subroutine {}_work(x)\n'.format(name),
+            '    real, intent(inout) :: x(:)\n', '    integer :: i\n' ]
+        for i in range(lines):
+            out.append('    x(i) = x(i) * {}.0 + {}.5  ! step {}\n'.format(i + 1, i, i))
+        out.append('  end subroutine\n')
+        return ''.join(out)
+
+    # modules in order of layers; a module only uses modules of lower layers
+    nmod = files * modules_per_file
+    layer_start = [ nmod * l // depth for l in range(depth + 1) ]
+    ninc = max(1, files // 50)
+    for k in range(ninc):
+        write('include/inc{}.inc'.format(k), '  integer, parameter :: inc{} = {}\n'.format(k, k))
+        summary['includes'] += 1
+
+    modules = list()
+    # indices of modules written so far (files of submodules have none)
+    indices = list()
+    for f in range(files):
+        subdir = 'src/d{}'.format(f // files_per_dir)
+        if modules and rnd.random() < submodules:
+            parent = rnd.choice(modules)
+            name = 's{}'.format(f)
+            write('{}/{}.f90'.format(subdir, name), 'submodule ({}) {}\n  implicit none\n{}'
+                'end submodule\n'.format(parent, name, body(name)))
+            summary['submodules'] += 1
+            summary['files'] += 1
+            continue
+        text = list()
+        for k in range(modules_per_file):
+            i = f * modules_per_file + k
+            layer = next(l for l in range(depth) if layer_start[l + 1] > i)
+            lower = bisect_left(indices, layer_start[layer])
+            name = 'm{}'.format(i)
+            text.append('module {}\n'.format(name))
+            for d in sorted(set(indices[rnd.randrange(lower)] for j in range(fanout))) if lower else ():
+                text.append('  use m{}\n'.format(d))
+            text.append('  implicit none\n')
+            if rnd.random() < includes:
+                text.append("  include 'inc{}.inc'\n".format(rnd.randrange(ninc)))
+            text.append(body(name))
+            text.append('end module\n\n')
+            modules.append(name)
+            indices.append(i)
+            summary['modules'] += 1
+        write('{}/f{}.f90'.format(subdir, f), ''.join(text))
+        summary['files'] += 1
+
+    top = modules[-max(1, len(modules) // depth):]
+    for p in range(programs):
+        uses = sorted(set(rnd.choice(top) for j in range(fanout)))
+        write('prog/p{}.f90'.format(p), 'program p{}\n{}  implicit none\nend program\n' \
+            .format(p, ''.join('  use {}\n'.format(m) for m in uses)))
+        summary['programs'] += 1
+
+    return summary
+
+#------------------------------------------------------------------------------#
+
+def main(argv = None):
+    from argparse import ArgumentParser
+    import json
+    parser = ArgumentParser('bench.generate')
+    parser.add_argument('--files', type = int, default = 1000,
+            help = 'number of source files (default: 1000)')
+    parser.add_argument('--modules-per-file', type = int, default = 1,
+            help = 'modules in each file (default: 1)')
+    parser.add_argument('--fanout', type = int, default = 3,
+            help = 'modules used by each module (default: 3)')
+    parser.add_argument('--depth', type = int, default = 10,
+            help = 'layers of modules (default: 10)')
+    parser.add_argument('--submodules', type = float, default = 0.1,
+            help = 'fraction of files which are submodules (default: 0.1)')
+    parser.add_argument('--includes', type = float, default = 0.05,
+            help = 'fraction of modules including a file (default: 0.05)')
+    parser.add_argument('--programs', type = int, default = 10,
+            help = 'number of programs (default: 10)')
+    parser.add_argument('--lines', type = int, default = 20,
+            help = 'lines of code in each module (default: 20)')
+    parser.add_argument('--seed', type = int, default = 1,
+            help = 'seed of the random generator (default: 1)')
+    parser.add_argument('root', help = 'directory to write the tree to')
+    args = parser.parse_args(argv)
+    summary = generate(args.root, args.files, args.modules_per_file, args.fanout,
+        args.depth, args.submodules, args.includes, args.programs, args.lines, args.seed)
+    print(json.dumps(summary, sort_keys = True))
+
+if __name__ == '__main__':
+    main()
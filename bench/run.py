@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmarks of fortdep and fortdep2: end-to-end runs of the command line
+tools and single stages, on synthetic trees of given sizes. Every
+measurement runs in a process of its own, so that its peak memory (RSS)
+can be reported. Times are the best of several runs.
+
+    python -m bench.run --sizes 1000,10000 --json new.json --compare old.json
+"""
+
+from os import path, chdir
+from sys import executable, stdout, stderr
+import json
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+
+#------------------------------------------------------------------------------#
+# stages, each measured in a process of its own: prepare(tree) returns the
+# input, run(input) does the work and returns the number of items processed
+
+def _sources():
+    from fortdep2 import find_sources
+    return [ path.join(reldir, fn) for reldir, filelist in find_sources() \
+        for fn in filelist ]
+
+def _read_all():
+    data = list()
+    for fp in _sources():
+        with open(fp, 'rb') as f:
+            data.append(f.read())
+    return data
+
+def _graph():
+    from fortdep2 import DependencyGraph
+    graph = DependencyGraph(log = None)
+    graph.add_files(_sources())
+    return graph
+
+def _fortdep_rules():
+    import fortdep
+    modules_obj, modules_uses, vpath = fortdep.scan_tree(
+        fortdep.find_sources(None, (), fortdep.re_fort))
+    return modules_obj, fortdep.make_dependencies(modules_obj, modules_uses)
+
+def stage_scan_source(data):
+    from fortdep2 import scan_source
+    for d in data: scan_source(d)
+    return len(data)
+
+def stage_parse_fortran_module(data):
+    from io import BytesIO
+    from fortdep import parse_fortran_module
+    for d in data: parse_fortran_module(BytesIO(d))
+    return len(data)
+
+def stage_walktree(graph):
+    from fortdep2 import walktree
+    for p in graph.programs(): walktree(p)
+    return len(graph.objfiles)
+
+def stage_closures(graph):
+    from fortdep2 import UnitGraph
+    UnitGraph(graph.universe).closures(graph.programs())
+    return len(graph.objfiles)
+
+def stage_optimize_dependencies(rules):
+    from fortdep import optimize_dependencies
+    optimize_dependencies(rules[1], 2)
+    return len(rules[1])
+
+def stage_fold(lines):
+    from fortdep import fold
+    for line in lines: fold(line)
+    return len(lines)
+
+def _fold_input():
+    modules_obj, deps = _fortdep_rules()
+    return [ 'OBJECTS = {}'.format(' '.join(modules_obj.values())),
+        '.INTERMEDIATE: {}'.format(' '.join(modules_obj.values())) ] \
+        + [ str(d) for d in deps ]
+
+stages = dict(
+    scan_source = (_read_all, stage_scan_source),
+    parse_fortran_module = (_read_all, stage_parse_fortran_module),
+    walktree = (_graph, stage_walktree),
+    closures = (_graph, stage_closures),
+    optimize_dependencies = (_fortdep_rules, stage_optimize_dependencies),
+    fold = (_fold_input, stage_fold),
+)
+
+def run_stage(name, tree, repeat):
+    """measure a stage in this process; prints the result as JSON"""
+    from time import perf_counter
+    chdir(tree)
+    prepare, work = stages[name]
+    data = prepare()
+    best = None
+    for i in range(repeat):
+        t = perf_counter()
+        items = work(data)
+        t = perf_counter() - t
+        best = t if best == None else min(best, t)
+    stdout.write(json.dumps(dict(seconds = best, items = items)) + '\n')
+
+#------------------------------------------------------------------------------#
+# command line tools: name -> (arguments, whether a run fills the cache first)
+
+commands = {
+    'cli:fortdep2': ([ path.join(root, 'fortdep2.py'), '--no-cache', '-p', '-o', 'bench.mk' ], False),
+    'cli:fortdep2-cached': ([ path.join(root, 'fortdep2.py'), '-p', '-o', 'bench.mk' ], True),
+    'cli:fortdep': ([ path.join(root, 'fortdep.py'), '-o', 'bench.mk' ], False),
+}
+
+def measure(argv, cwd):
+    """run a process; returns (seconds, peak RSS in MB, stdout)"""
+    from subprocess import Popen, PIPE, DEVNULL
+    from time import perf_counter
+    from os import wait4, waitstatus_to_exitcode
+    t = perf_counter()
+    p = Popen(argv, cwd = cwd, stdout = PIPE, stderr = DEVNULL)
+    out = p.stdout.read()
+    pid, status, usage = wait4(p.pid, 0)
+    t = perf_counter() - t
+    p.returncode = waitstatus_to_exitcode(status)
+    p.stdout.close()
+    if p.returncode != 0:
+        raise Exception('{} failed with status {}'.format(' '.join(argv), p.returncode))
+    return t, usage.ru_maxrss / 1024.0, out
+
+def benchmark(name, tree, files, repeat):
+    """result of one benchmark on a tree with given number of files"""
+    if name in commands:
+        argv, warm = commands[name]
+        if warm: measure([executable] + argv, tree)
+        runs = [ measure([executable] + argv, tree) for i in range(repeat) ]
+        seconds = min(r[0] for r in runs)
+        rss = max(r[1] for r in runs)
+        items = files
+    else:
+        t, rss, out = measure([executable, '-m', 'bench.run', '--stage', name,
+            '--repeat', str(repeat), tree], root)
+        result = json.loads(out)
+        seconds, items = result['seconds'], result['items']
+    return dict(name = name, size = files, seconds = seconds, items = items,
+        items_per_second = items / seconds if seconds > 0 else None,
+        max_rss_mb = rss)
+
+#------------------------------------------------------------------------------#
+
+def prepare_tree(workdir, size):
+    """generate (or reuse) the tree of given size in workdir"""
+    from bench.generate import generate
+    tree = path.join(workdir, 'tree{}'.format(size))
+    summary_file = path.join(tree, 'summary.json')
+    if not path.exists(summary_file):
+        summary = generate(tree, files = size)
+        with open(summary_file, 'w') as f:
+            json.dump(summary, f)
+    return tree
+
+def main(argv = None):
+    from argparse import ArgumentParser
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from platform import python_version
+
+    names = sorted(commands) + sorted(stages)
+    parser = ArgumentParser('bench.run')
+    parser.add_argument('--sizes', default = '1000,10000',
+            help = 'numbers of files in the trees, separated by commas '
+            '(default: 1000,10000; e.g. 1000,10000,100000)')
+    parser.add_argument('--only', default = ','.join(names),
+            help = 'benchmarks to run, separated by commas (default: all of '
+            '{})'.format(', '.join(names)))
+    parser.add_argument('--repeat', type = int, default = 3,
+            help = 'runs of each benchmark; the best time is taken (default: 3)')
+    parser.add_argument('--workdir', type = str,
+            help = 'keep generated trees in this directory (default: temporary)')
+    parser.add_argument('--json', type = str, metavar = 'FILE',
+            help = 'write the results to FILE')
+    parser.add_argument('--compare', type = str, metavar = 'FILE',
+            help = 'compare with results of a previous run')
+    parser.add_argument('--stage', choices = sorted(stages), help = \
+            'measure one stage in this process (used by the runner)')
+    parser.add_argument('tree', nargs = '?', help = 'tree for --stage')
+    args = parser.parse_args(argv)
+
+    if args.stage:
+        run_stage(args.stage, path.abspath(args.tree), args.repeat)
+        return
+
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as f:
+            for r in json.load(f)['results']:
+                baseline[r['name'], r['size']] = r
+
+    workdir = path.abspath(args.workdir) if args.workdir else mkdtemp(prefix = 'fortdep-bench-')
+    results = list()
+    try:
+        stdout.write('{:>7s} {:28s} {:>10s} {:>12s} {:>8s}{}\n'.format('files',
+            'benchmark', 'seconds', 'files/s', 'RSS MB', '   vs. old' if baseline else ''))
+        for size in (int(s) for s in args.sizes.split(',')):
+            tree = prepare_tree(workdir, size)
+            for name in args.only.split(','):
+                if name not in names:
+                    stderr.write('unknown benchmark {}\n'.format(name))
+                    continue
+                r = benchmark(name, tree, size, args.repeat)
+                results.append(r)
+                old = baseline.get((name, size))
+                stdout.write('{:7d} {:28s} {:10.4f} {:12.0f} {:8.1f}{}\n'.format(size,
+                    name, r['seconds'], r['items_per_second'] or 0, r['max_rss_mb'],
+                    '   {:6.2f}x'.format(old['seconds'] / r['seconds']) if old else ''))
+                stdout.flush()
+    finally:
+        if not args.workdir: rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(python = python_version(), results = results), f, indent = 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Startup of fortdep2, checked against a budget: the modules imported by a
+run on a small cached tree, the time to import fortdep2 (-X importtime)
+and the CPU time of trivial runs above that of the bare interpreter.
+Runs go the way of an installed fortdep2 command (import fortdep2, call
+main), with compiled bytecode cached. The status is 1 if startup regressed.
+
+Times are kept as multiples of the CPU time of the bare interpreter
+(python -c pass), and checked only with the Python version and kind of
+machine the budget was recorded with. The budget lists the top-level
+modules fortdep2 may import; the modules these import in turn are those
+of the interpreter running the check.
+
+    python -m bench.startup            # check against bench/startup.json
+    python -m bench.startup --update   # record the current state as the budget
+"""
+
+from os import path, environ
+from sys import executable, stdout, exit, version_info
+import platform
+import json
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+example = path.join(root, 'tests', 'example')
+budget_file = path.join(path.dirname(path.abspath(__file__)), 'startup.json')
+
+# what the fortdep2 command does, see setup.py
+entry = 'import fortdep2; fortdep2.main()'
+
+#------------------------------------------------------------------------------#
+
+def child_env():
+    env = dict(environ, PYTHONPATH = root)
+    # an installed package has its bytecode compiled
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+def importtime(argv):
+    """modules imported by a run, with cumulative microseconds of each"""
+    from subprocess import run, PIPE, DEVNULL
+    p = run([executable, '-X', 'importtime'] + argv, cwd = example, env = child_env(),
+        stdout = DEVNULL, stderr = PIPE, check = True)
+    modules = dict()
+    for line in p.stderr.decode().splitlines():
+        if not line.startswith('import time:'): continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit(): continue
+        modules[fields[2].strip()] = int(fields[1])
+    return modules
+
+def cpu_time(argv, repeat):
+    """
+    Best CPU time (user and system) of a run, in milliseconds; it varies
+    less than the wall time with the load of the machine.
+    """
+    from subprocess import Popen, DEVNULL
+    from os import wait4, waitstatus_to_exitcode
+    best = None
+    for i in range(repeat):
+        p = Popen([executable] + argv, cwd = example, env = child_env(),
+            stdout = DEVNULL, stderr = DEVNULL)
+        pid, status, usage = wait4(p.pid, 0)
+        p.returncode = waitstatus_to_exitcode(status)
+        if p.returncode != 0:
+            raise Exception('{} failed with status {}'.format(' '.join(argv), p.returncode))
+        t = (usage.ru_utime + usage.ru_stime) * 1000
+        best = t if best == None else min(best, t)
+    return best
+
+def imported(statement):
+    """modules imported by a statement, beyond those of the bare interpreter"""
+    return set(importtime([ '-c', statement ])) - set(importtime([ '-c', 'pass' ]))
+
+def toplevel(modules):
+    """public top-level modules, which do not depend on the Python version"""
+    return sorted(set(m.split('.')[0] for m in modules if not m.startswith('_')))
+
+def environment():
+    return dict(python = '{} {}.{}'.format(platform.python_implementation(),
+        *version_info[:2]), machine = platform.machine())
+
+def measure(repeat, cache):
+    run = [ '-c', entry, '--cache', cache, '.' ]
+    version = [ '-c', entry, '--version' ]
+    # fill the cache and compile the bytecode
+    cpu_time(run, 1)
+    base = cpu_time([ '-c', 'pass' ], repeat)
+    interpreter = set(importtime([ '-c', 'pass' ]))
+    import_ms = min(importtime([ '-c', 'import fortdep2' ])['fortdep2'] \
+        for i in range(repeat)) / 1000.0
+    return dict(environment(),
+        base_ms = base,
+        modules = sorted(set(importtime(run)) - interpreter),
+        # multiples of the time of the bare interpreter
+        import_x = import_ms / base,
+        version_x = (cpu_time(version, repeat) - base) / base,
+        cached_run_x = (cpu_time(run, repeat) - base) / base,
+    )
+
+#------------------------------------------------------------------------------#
+
+def main(argv = None):
+    from argparse import ArgumentParser
+    from tempfile import TemporaryDirectory
+
+    parser = ArgumentParser('bench.startup')
+    parser.add_argument('--repeat', type = int, default = 20,
+            help = 'runs of each measurement; the best time is taken (default: 20)')
+    parser.add_argument('--tolerance', type = float, default = 0.5,
+            help = 'allowed increase of times over the budget, as a fraction '
+            '(default: 0.5)')
+    parser.add_argument('--budget', type = str, metavar = 'FILE', default = budget_file,
+            help = 'budget to check against (default: bench/startup.json)')
+    parser.add_argument('--update', action = 'store_true',
+            help = 'write the measured values as the budget')
+    args = parser.parse_args(argv)
+
+    with TemporaryDirectory(prefix = 'fortdep-startup-') as tmp:
+        result = measure(args.repeat, path.join(tmp, 'cache'))
+
+    if args.update:
+        budget = dict(environment(),
+            imports = toplevel(set(result['modules']) - set([ 'fortdep2' ])))
+        for name in ('import_x', 'version_x', 'cached_run_x'):
+            budget[name] = round(result[name], 3)
+        with open(args.budget, 'w') as f:
+            json.dump(budget, f, indent = 1)
+            f.write('\n')
+        stdout.write('budget written to {}\n'.format(args.budget))
+        return 0
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    failed = False
+    stdout.write('bare interpreter {:.1f} ms\n'.format(result['base_ms']))
+    recorded = (budget['python'], budget['machine'])
+    if recorded == (result['python'], result['machine']):
+        for name in ('import_x', 'version_x', 'cached_run_x'):
+            limit = budget[name] * (1 + args.tolerance)
+            ok = result[name] <= limit
+            failed = failed or not ok
+            stdout.write('{:14s} {:8.2f}x   budget {:6.2f}x, limit {:6.2f}x  {}\n'.format(
+                name, result[name], budget[name], limit, 'ok' if ok else 'REGRESSED'))
+    else:
+        stdout.write('times not checked: the budget is for {} on {}, this is {} on {}\n' \
+            .format(budget['python'], budget['machine'], result['python'], result['machine']))
+
+    # what the allowed modules import with this interpreter
+    allowed = imported('import ' + ', '.join(budget['imports'])) | set([ 'fortdep2' ])
+    extra = sorted(set(result['modules']) - allowed)
+    stdout.write('{:14s} {:8d}      allowed {:5d}  {}\n'.format('modules',
+        len(result['modules']), len(allowed), 'ok' if not extra else 'REGRESSED'))
+    if extra:
+        failed = True
+        stdout.write('new imports: {}\n'.format(', '.join(extra)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -2,72 +2,65 @@
 # coding: utf-8
 
 from sys import stdout, stderr, argv
-from os import listdir, path, getcwd, walk
-from re import match, compile as re_compile, split as re_split
+from os import path, environ
+from re import match, compile as re_compile, IGNORECASE, MULTILINE
+from fortdep2 import find_sources, read_makefile_vpath, write_if_changed, \
+    compress_rules, intrinsic_modules, find_manifests, load_manifest, FoldWriter
 
 
 re_fort = re_compile(r'(.*)\.[fF](90|95|03|08|)$')
-re_module = re_compile(r'^\s*(module|program|submodule\s*\(\s*([a-zA-Z0-9_]+)\s*\))\s+([a-zA-Z0-9_]+)')
-re_submodule = re_compile(r'submodule\s*\(\s*([a-zA-Z0-9_]+)\s*\)')
-re_use = re_compile(r'^\s*use\s+([a-zA-Z0-9_]+)')
-re_vpathsep = re_compile(r'[:\s]')
+# module and use statements, for searching the entire file at once
+re_statement = re_compile(br'^[^\S\n]*(?:(module|program|submodule[^\S\n]*\([^\S\n]*([a-z0-9_]+)[^\S\n]*\))[^\S\n]+([a-z0-9_]+)|use[^\S\n]+([a-z0-9_]+))', IGNORECASE | MULTILINE)
 
-modules_standard = set([
-    'iso_fortran_env',
-    'iso_c_binding',
-    'ieee_arithmetic',
-])
+modules_standard = set(intrinsic_modules)
 
 verbose = False
 
-VPATH = set()
-modules_obj = dict()
-modules_uses = dict()
-
 def log(s, priority = 0):
     if verbose or priority > 0:
         for s0 in s.split('\n'):
             stderr.write(" * {}\n".format(s0))
 
 def parse_fortran_module(f):
+    # the whole file is searched at once; only the statements of interest
+    # are decoded, so the encoding of the file does not matter
+    data = f.read()
+    if isinstance(data, str): data = data.encode('utf-8', 'surrogateescape')
     # when module name is found, it will be set here
     module_name = None
     # module dependencies will be listed here
     module_uses = set()
-    for line in f:
-        line = line.lower()
+    for m in re_statement.finditer(data):
         # module definition not encountered yet
         if not module_name:
             # try to match "MODULE name" formula
-            m = match(re_module,line)
-            if m:
-                module_type, module_parent, name = m.groups()
-                if module_type == 'module':
-                    module_name = "{n}".format(n = name)
-                elif module_type == 'program':
-                    module_name = "program {n}".format(n = name)
-                elif module_parent != None:
-                    module_name = "{p}.{n}".format(n = name,
-                        p = module_parent)
-                    module_uses.add(module_parent)
-                else: raise Exception('something went wrong while ' \
-                        'recognizing module type')
-
-                log("encountered {}".format(module_name))
+            if m.group(1) == None: continue
+            module_type = m.group(1).decode('ascii').lower()
+            module_parent = m.group(2)
+            name = m.group(3).decode('ascii').lower()
+            if module_type == 'module':
+                module_name = "{n}".format(n = name)
+            elif module_type == 'program':
+                module_name = "program {n}".format(n = name)
+            elif module_parent != None:
+                module_parent = module_parent.decode('ascii').lower()
+                module_name = "{p}.{n}".format(n = name,
+                    p = module_parent)
+                module_uses.add(module_parent)
+            else: raise Exception('something went wrong while ' \
+                    'recognizing module type')
+
+            log("encountered {}".format(module_name))
             # end if
-        else:
+        elif m.group(4) != None:
             # module name found already, we are inside the module
-            # trying to match "USE name" statement
-            m2 = match(re_use,line)
-            if m2:
-                # if matched, add to dependency list
-                dep = m2.group(1)
-                # if this is an intrinsic Fortran module, skip
-                if dep in modules_standard: continue
-                log(u"  -> uses module {}".format(dep))
-                # add to dependency list
-                module_uses.add(dep)
-            # end if
+            # and this is "USE name" statement
+            dep = m.group(4).decode('ascii').lower()
+            # if this is an intrinsic Fortran module, skip
+            if dep in modules_standard: continue
+            log(u"  -> uses module {}".format(dep))
+            # add to dependency list
+            module_uses.add(dep)
         # end if
     # end for
     return module_name, module_uses
@@ -84,104 +77,32 @@ class Dependency(object):
 
     def __str__(self):
         return "{:16s}: {}".format(
-            " ".join([modules_obj[m] for m in self.targets]),
-            " ".join([modules_obj[m] for m in self.prerequisites]),
+            " ".join(sorted(self.targets)),
+            " ".join(sorted(self.prerequisites)),
         )
 
-def find_optimizations(D):
-    optimizations = list()
-    for i0 in range(len(D)):
-        for i1 in range(i0+1, len(D)):
-            if D[i0].L == D[i1].L:
-                # remove 1, merge into 2
-                optimizations.append(( 'L', i0, i1, len(D[i0].L) ))
-            elif D[i0].L >= D[i1].L:
-                # merge 1 into 2 (move L, merge R)
-                b = len(D[i1].L) - len(D[i0].R)
-                if b > 0: optimizations.append(( 'L', i0, i1, b ))
-            elif D[i0].L <= D[i1].L:
-                # merge 2 into 1 (move L, merge R)
-                b = len(D[i0].L) - len(D[i1].R)
-                if b > 0: optimizations.append(( 'L', i1, i0, b ))
-            elif D[i0].R == D[i1].R:
-                # merge 1 into 2 (merge L, move R)
-                b = len(D[i0].R)
-                if b > 0: optimizations.append(( 'R', i0, i1, b ))
-            elif D[i0].R >= D[i1].R:
-                # merge 1 into 2 (merge L, move R)
-                b = len(D[i1].R) - len(D[i0].L)
-                if b > 0: optimizations.append(( 'R', i0, i1, b ))
-            elif D[i0].R <= D[i1].R:
-                # merge 2 into 1 (merge L, move R)
-                b = len(D[i0].R) - len(D[i1].L)
-                if b > 0: optimizations.append(( 'R', i1, i0, b ))
-            # end if
-        # end for
-    # end for
-    return optimizations
-
-
-def optimize_dependencies(D0, iter = 8):
-    D = list(D0)
-    for it in range(iter):
-        opt = find_optimizations(D)
-        if len(opt) == 0:
-            log("cannot optimize further: " \
-                "stopped after {} iterations".format(it+1), 5)
-            break
-        opt.sort(cmp = lambda x,y: 1 if x[3] < y[3] else (-1 if x[3] > y[3] else 0))
-        optimized = set()
-        to_del = list()
-
-        for op,i0,i1,benefit in opt:
-            if i0 in optimized or i1 in optimized: continue
-            if op == 'L':
-                if not D[i0].L >= D[i1].L: raise Exception('corrupted dependency list')
-                d0 = Dependency(D[i0].L - D[i1].L, D[i0].R)
-                d1 = Dependency(D[i1].L, D[i1].R | D[i0].R)
-                if len(d0.L) == 0: to_del.append(i0)
-            elif op == 'R':
-                if not D[i0].R >= D[i1].R: raise Exception('corrupted dependency list')
-                d0 = Dependency(D[i0].L, D[i0].R - D[i1].R)
-                d1 = Dependency(D[i1].L | D[i0].L, D[i1].R)
-                if len(d0.R) == 0: to_del.append(i0)
-            else:
-                raise Exception('wrong operation')
-            # end if
-            log("Optimized {} (benefit = {})\n{}\n{}\n      replaced with\n{}\n{}\n".format(op, benefit,
-                str(D[i0]), str(D[i1]), str(d0), str(d1)))
-            D[i0], D[i1] = d0, d1
-            optimized.add(i0)
-            optimized.add(i1)
-
-        to_del.sort(reverse = True)
-        for i in to_del:
-            log("DELETING\n{}".format(str(D[i])))
-            del D[i]
-    # end for
+def optimize_dependencies(D0, level = 2):
+    """
+    Shorten the list of dependencies: objects with the same prerequisites
+    share one rule and, from level 2, prerequisites common to many rules
+    are written once (see fortdep2.compress_rules).
+    """
+    rules = compress_rules([ (d.L, d.R) for d in D0 ], nested = level > 1)
+    D = [ Dependency(targets, prerequisites) for targets, prerequisites in rules ]
+    log("optimized {} rules ({} words) into {} rules ({} words)".format(
+        len(D0), sum(len(d.L) + len(d.R) for d in D0),
+        len(D), sum(len(d.L) + len(d.R) for d in D)), 5)
     return D
 
 
 def fold(s, lc = '\\', lw = 80):
-    o = list()
-    buf_line = u""
-    buf_word = u""
-    for c in s + ' ':
-        if c.isspace():
-            if len(buf_line) + len(buf_word) + len(lc) >= lw:
-                buf_line = buf_line + " " * (lw - len(buf_line) - len(lc)) + lc
-                o.append(buf_line)
-                buf_line = u"    "
-            buf_line += buf_word
-            buf_line += c
-            buf_word = u""
-        # end if c.isspace()
-        else:
-            buf_word += c
-        #end else
-    # end for
-    o.append(buf_line + buf_word)
-    return "\n".join(o)
+    """fold a line at word boundaries (see fortdep2.FoldWriter)"""
+    from io import StringIO
+    buf = StringIO()
+    out = FoldWriter(buf, lw, lc)
+    out.line(s)
+    out.flush()
+    return buf.getvalue()[:-1]
 
 def parse_cmdline_args(argv):
     from argparse import ArgumentParser
@@ -197,7 +118,11 @@ def parse_cmdline_args(argv):
             help = 'mark all objects as intermediate')
     parser.add_argument('--optimize', '-O',
             type = int, choices = [0,1,2,3], default = 0,
-            help = 'optimize (shorten) code')
+            help = 'optimize (shorten) code: 1 merges rules with the same '
+            'prerequisites, 2 and 3 also factor out common prerequisites')
+    parser.add_argument('--exclude', '-x', action = 'append', default = [],
+            metavar = 'PATTERN', help = 'skip files and directories matching '
+            'the pattern (.gitignore syntax)')
     parser.add_argument('--output', '-o',
             type = str, default = '--',
             help = 'write output to file')
@@ -205,42 +130,15 @@ def parse_cmdline_args(argv):
 
     return parser.parse_args(argv[1:])
 
-def check_makefile_vpath():
-    from subprocess import check_output
-    o = check_output([
-        'make',
-        '--eval=print_vpath:\n\t@echo $(VPATH)',
-        'print_vpath',
-    ]).decode().replace('\n','')
-    if o != '': return re_split(re_vpathsep, o)
-
-def main():
-    # main program starts here: parse command line args
-    args = parse_cmdline_args(argv)
-
-    # set the global verbose flag
-    global verbose
-    verbose = args.verbose
-
-    # if no output file given, write to stdout
-    output = stdout if args.output == '--' else open(args.output,'w')
-
-    if len(args.path) == 0:
-        make_vpath = check_makefile_vpath()
-        if make_vpath:
-            log('found Makefile, using directories: {}'.format(", ".join(make_vpath)), 2)
-            inp = [ (folder, [ f for f in listdir(folder)       \
-                    if path.isfile(path.join(folder,f)) ])      \
-                    for folder in make_vpath ]
-        else:
-            log(u'no directories given; scanning recursively...', 2)
-            cwd = getcwd()
-            inp = [ (path.relpath(fd,cwd),fl) for fd,lf,fl in walk(cwd) ]
-    else:
-        inp = [ (folder, [ f for f in listdir(folder)       \
-                if path.isfile(path.join(folder,f)) ])      \
-                for arg in args.path for folder in arg.split(':')  ]
-
+def scan_tree(inp):
+    """
+    Parse sources given as a list of (directory, [files]). Returns
+    dictionaries mapping module names to object files and to sets
+    of modules they use, and the list of directories with sources.
+    """
+    modules_obj = dict()
+    modules_uses = dict()
+    vpath = list()
 
     for reldir, filelist in inp:
         for fn in filelist:
@@ -254,9 +152,9 @@ def main():
             # write to log
             log(u"{obj} -> {fil}".format(obj = objname, fil = filepath))
             # add the directory to vpath
-            VPATH.add(reldir)
+            if reldir not in vpath: vpath.append(reldir)
 
-            with open(filepath,'r') as f:
+            with open(filepath,'rb') as f:
                 module_name, module_uses = parse_fortran_module(f)
 
                 # if module not found, it is old fortran: skip
@@ -271,32 +169,78 @@ def main():
         # end for
     #end for
 
-    broken_deps = list()
-    for tgt,deps in modules_uses.items():
+    return modules_obj, modules_uses, vpath
+
+def make_dependencies(modules_obj, modules_uses, external = ()):
+    """
+    List of dependencies between object files, skipping modules
+    which were not found in any file. Modules from external (of prebuilt
+    libraries) are skipped without a warning.
+    """
+    dependencies = list()
+    for tgt, deps in sorted(modules_uses.items(), key = lambda x: x[0]):
         for dep in deps:
-            if dep not in modules_obj:
+            if dep not in modules_obj and dep not in external:
                 log(u"warning: object file for module {} not found.".format(dep), 10)
-                broken_deps.append((tgt,dep))
-    # broken deps elements are sets, so we need to do it in a separate loop
-    for tgt,dep in broken_deps:
-        modules_uses[tgt].remove(dep)
+        deps = [ modules_obj[dep] for dep in deps if dep in modules_obj ]
+        if len(deps) > 0:
+            dependencies.append(Dependency([modules_obj[tgt]], deps))
+    return dependencies
+
+def main():
+    # main program starts here: parse command line args
+    args = parse_cmdline_args(argv)
 
-    deps_sort = sorted(modules_uses.items(), key = lambda x: x[0])
-    dependencies = [ Dependency([tgt], deps) for tgt,deps in deps_sort if len(deps) > 0 ]
+    # set the global verbose flag
+    global verbose
+    verbose = args.verbose
+
+    # if no output file given, write to stdout; a file is only written
+    # if its content changes
+    if args.output == '--':
+        output = stdout
+    else:
+        from io import StringIO
+        output = StringIO()
+
+    if len(args.path) == 0:
+        make_vpath = read_makefile_vpath()
+        if make_vpath:
+            log('found Makefile, using directories: {}'.format(", ".join(make_vpath)), 2)
+            inp = find_sources(make_vpath, args.exclude, re_fort)
+        else:
+            log(u'no directories given; scanning recursively...', 2)
+            inp = find_sources(None, args.exclude, re_fort)
+    else:
+        inp = find_sources([ folder for arg in args.path \
+                for folder in arg.split(':') ], args.exclude, re_fort)
+
+
+    modules_obj, modules_uses, vpath = scan_tree(inp)
+    # modules of prebuilt libraries, from manifests written by fortdep2
+    external = set(name for fn in find_manifests(environ.get('FORTDEP_MANIFEST_PATH',
+        '').split(':')) for name in load_manifest(fn)['modules'])
+    dependencies = make_dependencies(modules_obj, modules_uses, external)
 
     if args.optimize > 0:
-        dependencies = optimize_dependencies(dependencies, args.optimize * 3)
+        dependencies = optimize_dependencies(dependencies, args.optimize)
 
+    # rules are folded and streamed through one buffered writer
+    out = FoldWriter(output, 80)
     if args.objects:
-        output.write(fold("OBJECTS = {}\n".format(" ".join(modules_obj.values()))) + "\n")
+        out.words(['OBJECTS', '='] + list(modules_obj.values()))
     if args.vpath:
-        output.write("VPATH = {}\n".format(":".join(VPATH)))
+        out.write("VPATH = {}\n".format(":".join(vpath)))
 
     for d in dependencies:
-        output.write(fold(str(d)) + "\n")
+        out.line(str(d))
 
     if args.intermediate:
-        output.write(fold(".INTERMEDIATE: {}".format(" ".join(modules_obj.values()))) + "\n")
+        out.words(['.INTERMEDIATE:'] + list(modules_obj.values()))
+    out.flush()
+
+    if output != stdout:
+        write_if_changed(args.output, output.getvalue())
 
 if __name__ == '__main__':
     main()
@@ -1,22 +1,59 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from sys import stdout, stderr
-from os import listdir, path, getcwd, walk
+from sys import stdout, stderr, intern, exit
+from os import path, stat, getpid, scandir, environ, getcwd
 import re
 
+__version__ = '191215'
+
+# changes whenever the cached results of scanning would be different
+cache_format = 2
+
 #------------------------------------------------------------------------------#
 #------------------------------------------------------------------------------#
 
-re_fortext = re.compile(r'\.[fF](90|95|03|08|15|18|)$')
+class LazyRegex(object):
+    """
+    Regular expression compiled on first use, so that starting the program
+    does not pay for patterns it does not need. Methods of the pattern are
+    kept in the instance once looked up, so later calls cost nothing more.
+    """
+    def __init__(self, *args):
+        self._args = args
+        self._compiled = None
+
+    def __getattr__(self, name):
+        if self._compiled == None:
+            self._compiled = re.compile(*self._args)
+        value = getattr(self._compiled, name)
+        setattr(self, name, value)
+        return value
+
+re_fortext = LazyRegex(r'\.[fF](90|95|03|08|15|18|)$')
+
+# modules provided by the compiler
+intrinsic_modules = frozenset([ 'iso_fortran_env', 'iso_c_binding',
+    'ieee_arithmetic', 'ieee_exceptions', 'ieee_features',
+    'omp_lib', 'omp_lib_kinds', 'openacc' ])
+
+# manifests of prebuilt libraries are found by this suffix
+manifest_suffix = '.fortdep.json'
 
 #------------------------------------------------------------------------------#
 
 class SourceFile(object):
-    def __init__(self, fnsrc):
+    __slots__ = ('fnsrc', 'fnobj', 'fnexe', 'units', 'filepath', 'records')
+    def __init__(self, fnsrc, filepath = None):
         self.fnsrc = fnsrc
-        self.fnobj = re.sub(re_fortext, '.o', fnsrc)
-        self.fnexe = re.sub(re_fortext, '', fnsrc)
+        # path of the file, if it was read from one
+        self.filepath = filepath
+        # what scan_source found in the file
+        self.records = None
+        self.fnobj = re_fortext.sub('.o', fnsrc)
+        self.fnexe = re_fortext.sub('', fnsrc)
+        # units defined in this file, in order of appearance
+        self.units = list()
     def __repr__(self):
         return self.fnobj
 
@@ -32,16 +69,21 @@ class SourceFile(object):
 #------------------------------------------------------------------------------#
 
 class Unit(object):
+    __slots__ = ('name', 'objfile', 'deps', 'includes')
     def __init__(self, name, objfile = None):
         self.objfile = objfile
-        self.name = name.lower()
+        # names are interned so that dictionary lookups and comparisons
+        # in the registry are done mostly by identity
+        self.name = intern(name.lower())
         self.deps = set()
         self.includes = set()
+        if objfile: objfile.units.append(self)
     def assign_object_file(self, objfile):
         assert type(objfile) == SourceFile
         if self.objfile: raise Exception(u'Module {} is already assigned'
             ' to {}'.format(self.name, self.objfile))
         self.objfile = objfile
+        objfile.units.append(self)
     def __repr__(self):
         return  ('program ' if type(self) == Program else '') \
             + self.name + (' /' + self.objfile.fnsrc + '/' if self.objfile else '')
@@ -54,161 +96,629 @@ class Unit(object):
 #------------------------------------------------------------------------------#
 
 class Program(Unit):
+    __slots__ = ()
     def __init__(self, name, objfile):
         Unit.__init__(self, name, objfile)
 
 #------------------------------------------------------------------------------#
 
 class Module(Unit):
+    __slots__ = ('submodules',)
     def __init__(self, name, objfile = None):
         Unit.__init__(self, name, objfile)
         self.submodules = set()
 
 #------------------------------------------------------------------------------#
+
+class Universe(object):
+    """
+    Registry of all units. Modules are indexed by their (lowercase) name,
+    so that every lookup is done in constant time. Programs are kept in
+    order of appearance, with a separate name index.
+    """
+    __slots__ = ('modules', 'programs', 'program_index')
+    def __init__(self):
+        self.modules = dict()
+        self.programs = list()
+        self.program_index = dict()
+    def __iter__(self):
+        for m in self.modules.values(): yield m
+        for p in self.programs: yield p
+    def __len__(self):
+        return len(self.modules) + len(self.programs)
+    def add_program(self, p):
+        self.programs.append(p)
+        self.program_index.setdefault(p.name, p)
+        return p
+    def query_modules(self, name):
+        return self.modules.get(name.lower())
+    def query_programs(self, name):
+        return self.program_index.get(name.lower())
+    def query_modules_or_new(self, name):
+        name = intern(name.lower())
+        m = self.modules.get(name)
+        if m == None:
+            m = self.modules[name] = Module(name)
+        return m
+    def check(self, records, objfil):
+        """
+        Raise the error merge would raise for records of file objfil (a
+        module defined twice), before anything is changed.
+        """
+        defined = set()
+        for mtype, mname, mparent, uses, includes in records:
+            if mtype == 'program': continue
+            name = mname.lower()
+            m = self.modules.get(name)
+            if name in defined or m != None and m.objfile:
+                raise Exception(u'Module {} is already assigned to {}'.format(name,
+                    m.objfile if m != None and m.objfile else objfil))
+            defined.add(name)
+
+    def merge(self, records, objfil, log = None):
+        """
+        Add units found by scan_source in file objfil. If log is given,
+        each step is reported there.
+        """
+        for mtype, mname, mparent, uses, includes in records:
+            if mtype == 'program':
+                current_module = self.add_program(Program(mname, objfil))
+                if log: log.write(u'+ program {}\n'.format(mname))
+            elif mtype == 'module':
+                # search for blank modules in the universe before adding
+                current_module = self.query_modules_or_new(mname)
+                current_module.assign_object_file(objfil)
+                if log: log.write(u'+ module {}\n'.format(mname))
+            else:
+                # for submodules, first search if parent is defined
+                parent_module = self.query_modules_or_new(mparent)
+                # search for blank modules in the universe before adding
+                current_module = self.query_modules_or_new(mname)
+                current_module.assign_object_file(objfil)
+                current_module.deps.add(parent_module)
+                parent_module.submodules.add(current_module)
+                if log: log.write(u'+ module {}, submodule of {}\n'.format(mname, mparent))
+
+            for name in uses:
+                # use statement matched; add as dependency
+                mdep = self.query_modules_or_new(name)
+                current_module.deps.add(mdep)
+                if log: log.write('* {} uses {}\n'.format(current_module, mdep))
+
+            for name in includes:
+                current_module.includes.add(name)
+                if log: log.write('* {} includes {}\n'.format(current_module, name))
+
 #------------------------------------------------------------------------------#
 
-universe = set()
-objfiles = set()
+def linked_units(u):
+    """units that must be linked together with u"""
+    for d in u.deps:
+        if d.objfile != None: yield d
+    if hasattr(u, 'submodules'):
+        for d in u.submodules:
+            if d.objfile != None: yield d
 
 #------------------------------------------------------------------------------#
 
-def query_modules(name):
-    return next(filter(lambda u: (type(u) == Module) \
-        and (u.name == name.lower()), universe), None)
+def archive_name(directory):
+    """
+    Static library with the objects of sources in a directory: src/io ->
+    libsrc_io.a; for the current directory, it is named after it.
+    """
+    parts = [ p for p in path.normpath(directory or '.').split(path.sep) \
+        if p not in ('', '.', '..') ]
+    return 'lib{}.a'.format('_'.join(parts or [ path.basename(path.abspath('.')) or 'main' ]))
 
 #------------------------------------------------------------------------------#
 
-def query_modules_or_new(name):
-    global universe
-    m = query_modules(name)
-    if m == None:
-        m = Module(name)
-        universe.add(m)
-    return m
+def parent_module(u):
+    """parent of a submodule (module or submodule), None for modules"""
+    for d in u.deps:
+        if hasattr(d, 'submodules') and u in d.submodules: return d
+
+def interface_files(u, moddir = None):
+    """
+    Module files written by the compiler when compiling unit u: name.mod
+    for modules and, if the unit has submodules, name.smod for modules and
+    ancestor@name.smod for submodules (as gfortran names them).
+    """
+    files = list()
+    if type(u) != Module: return files
+    parent = parent_module(u)
+    if parent == None:
+        files.append(u.name + '.mod')
+    if u.submodules:
+        files.append(smod_file(u))
+    return [ path.join(moddir, f) for f in files ] if moddir else files
+
+def smod_file(u):
+    """file with the interface of a module for its submodules"""
+    ancestor, parent = u, parent_module(u)
+    while parent != None:
+        ancestor, parent = parent, parent_module(parent)
+    return (ancestor.name + '@' if ancestor != u else '') + u.name + '.smod'
 
 #------------------------------------------------------------------------------#
 
-def walktree(u, bag = set()):
+def walktree(u):
+    # iterative, so that deep trees do not hit the recursion limit
     harvest = set((u,))
+    stack = [u]
+    while stack:
+        for d in linked_units(stack.pop()):
+            if not d in harvest:
+                harvest.add(d)
+                stack.append(d)
+    return harvest
 
-    deps = set(filter(lambda x: x.objfile != None, u.deps))
-    if hasattr(u, 'submodules'):
-        deps |= set(filter(lambda x: x.objfile != None, u.submodules))
+#------------------------------------------------------------------------------#
 
-    new_bag = bag | deps | set((u,))
+def strongly_connected(edges):
+    """
+    Iterative Tarjan's algorithm. Nodes are integers 0..n-1 and edges[i]
+    lists the successors of node i. Returns the list of strongly connected
+    components, each component placed after all the components it leads to.
+    """
+    n = len(edges)
+    index = [-1] * n
+    lowlink = [0] * n
+    onstack = [False] * n
+    stack = list()
+    components = list()
+    counter = 0
+    for root in range(n):
+        if index[root] >= 0: continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onstack[root] = True
+        work = [(root, 0)]
+        while work:
+            v, i = work[-1]
+            if i < len(edges[v]):
+                work[-1] = (v, i + 1)
+                w = edges[v][i]
+                if index[w] < 0:
+                    index[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    onstack[w] = True
+                    work.append((w, 0))
+                elif onstack[w] and index[w] < lowlink[v]:
+                    lowlink[v] = index[w]
+                continue
+            work.pop()
+            if work:
+                u = work[-1][0]
+                if lowlink[v] < lowlink[u]: lowlink[u] = lowlink[v]
+            if lowlink[v] == index[v]:
+                component = list()
+                while True:
+                    w = stack.pop()
+                    onstack[w] = False
+                    component.append(w)
+                    if w == v: break
+                components.append(component)
+    return components
 
-    for d in deps:
-        if not d in bag:
-            harvest |= walktree(d, new_bag)
-    return harvest
+#------------------------------------------------------------------------------#
+
+def iterbits(b):
+    """indices of bits set in integer b"""
+    s = bin(b)[:1:-1]
+    i = s.find('1')
+    while i >= 0:
+        yield i
+        i = s.find('1', i + 1)
 
 #------------------------------------------------------------------------------#
+
+class UnitGraph(object):
+    """
+    Graph of units linked by linked_units(), condensed into strongly
+    connected components. Transitive closures are computed once per
+    component, in topological order, as bitsets over the unit index, so
+    that programs sharing parts of the tree share the work.
+    """
+    __slots__ = ('units', 'index', 'edges', 'components', 'component_of')
+
+    def __init__(self, units):
+        self.units = list(units)
+        self.index = dict((u, i) for i, u in enumerate(self.units))
+        self.edges = [ [ self.index[d] for d in linked_units(u) ] \
+                for u in self.units ]
+        self.components = strongly_connected(self.edges)
+        self.component_of = [0] * len(self.units)
+        for c, members in enumerate(self.components):
+            for v in members: self.component_of[v] = c
+
+    def closures(self, roots):
+        """
+        Return a dictionary mapping each unit in roots to the set of units
+        it must be linked with (including itself). Bitsets of components
+        are released as soon as no other component needs them.
+        """
+        roots = list(roots)
+        edges, component_of = self.edges, self.component_of
+        wanted = set(component_of[self.index[r]] for r in roots)
+
+        # mark components reachable from the roots and count how many
+        # times each of them will be consumed by its predecessors
+        reachable = [False] * len(self.components)
+        refcount = [0] * len(self.components)
+        for c in wanted: reachable[c] = True
+        for c in range(len(self.components) - 1, -1, -1):
+            if not reachable[c]: continue
+            for v in self.components[c]:
+                for w in edges[v]:
+                    s = component_of[w]
+                    if s == c: continue
+                    reachable[s] = True
+                    refcount[s] += 1
+
+        # components are ordered so that successors come first
+        bitsets = dict()
+        for c, members in enumerate(self.components):
+            if not reachable[c]: continue
+            b = 0
+            for v in members:
+                b |= 1 << v
+                for w in edges[v]:
+                    s = component_of[w]
+                    if s == c: continue
+                    b |= bitsets[s]
+                    refcount[s] -= 1
+                    if refcount[s] == 0 and s not in wanted: del bitsets[s]
+            bitsets[c] = b
+
+        return dict((r, set(self.units[i] for i in \
+            iterbits(bitsets[component_of[self.index[r]]]))) for r in roots)
+
 #------------------------------------------------------------------------------#
 
-# compile regexp
-re_module = re.compile(r'\s*(module|program|submodule\s*\(\s*([a-z0-9_]+)\s*\))\s+([a-z0-9_]+)', re.IGNORECASE)
-re_module_end = re.compile(r'^\s*end\s+(module|submodule|program)', re.IGNORECASE)
-re_submodule = re.compile(r'submodule\s*\(\s*([a-z0-9_]+)\s*\)', re.IGNORECASE)
-re_use = re.compile(r'^\s*use\s+([a-z0-9_]+)', re.IGNORECASE)
-re_include = re.compile(r'^\s*include\s+["\'](.+)["\']', re.IGNORECASE)
+def use_cycles(units):
+    """
+    Find groups of modules which (directly or indirectly) use each other.
+    Only use statements are followed; the link between a submodule and
+    its parent is not a cycle.
+    """
+    units = list(units)
+    index = dict((u, i) for i, u in enumerate(units))
+    edges = [ [ index[d] for d in u.deps ] for u in units ]
+    return [ sorted((units[v] for v in c), key = lambda u: u.name) \
+        for c in strongly_connected(edges) \
+        if len(c) > 1 or c[0] in edges[c[0]] ]
 
 #------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
 
-verbose = False
+# module, program, submodule, end, use and include statements, for searching
+# the entire file at once, compiled when first used; [^\S\n] is the
+# whitespace that does not break the line
+re_statement = LazyRegex(br"""^[^\S\n]*(?:
+      (?P<unit>module|program|submodule[^\S\n]*\([^\S\n]*(?P<parent>[a-z0-9_]+)
+        (?:[^\S\n]*:[^\S\n]*(?P<parent2>[a-z0-9_]+))?[^\S\n]*\))
+        [^\S\n]+(?P<name>[a-z0-9_]+)
+    | end[^\S\n]+(?P<end>module|submodule|program)
+    | use[^\S\n]+(?P<use>[a-z0-9_]+)
+    | include[^\S\n]+["'](?P<include>.+)["']
+    )""", re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+
+#------------------------------------------------------------------------------#
+# preprocessor conditionals, evaluated in sources which the compiler runs
+# through the preprocessor (.F90 etc.), so that uses in inactive branches
+# (#ifdef USE_MPI...) do not make dependencies
+
+re_preprocessed = LazyRegex(r'\.F[0-9]*$')
+re_directive = LazyRegex(br'^[ \t]*#[ \t]*([a-z]+)[ \t]*(.*?)[ \t]*\r?$', re.MULTILINE)
+re_cpp_token = LazyRegex(r'''\s*(?:
+      (?P<number>0[xX][0-9a-fA-F]+|[0-9]+)[uUlL]*
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%<>!~&|^()])
+    )''', re.VERBOSE)
+
+# binary operators by precedence, as in C
+_cpp_binary = {
+    '*': (10, lambda a, b: a * b), '/': (10, lambda a, b: int(a / b)),
+    '%': (10, lambda a, b: a - b * int(a / b)),
+    '+': (9, lambda a, b: a + b), '-': (9, lambda a, b: a - b),
+    '<<': (8, lambda a, b: a << b), '>>': (8, lambda a, b: a >> b),
+    '<': (7, lambda a, b: int(a < b)), '>': (7, lambda a, b: int(a > b)),
+    '<=': (7, lambda a, b: int(a <= b)), '>=': (7, lambda a, b: int(a >= b)),
+    '==': (6, lambda a, b: int(a == b)), '!=': (6, lambda a, b: int(a != b)),
+    '&': (5, lambda a, b: a & b), '^': (4, lambda a, b: a ^ b), '|': (3, lambda a, b: a | b),
+    '&&': (2, lambda a, b: int(bool(a and b))), '||': (1, lambda a, b: int(bool(a or b))),
+}
+
+def cpp_evaluate(expr, defines, depth = 0):
+    """
+    Value of the expression of #if: integers, macros (undefined ones are 0),
+    defined(NAME) and the operators of C except ?:; && and || do not
+    evaluate their right side if the left one decides. Raises ValueError if
+    the expression cannot be evaluated (function-like macros, division by
+    zero, for instance).
+    """
+    tokens = list()
+    pos = 0
+    expr = expr.split('//')[0].split('/*')[0].strip()
+    while pos < len(expr):
+        mtch = re_cpp_token.match(expr, pos)
+        if mtch == None or mtch.end() == pos:
+            if expr[pos:].strip() == '': break
+            raise ValueError('cannot evaluate {}'.format(expr))
+        pos = mtch.end()
+        tokens.append((mtch.lastgroup, mtch.group(mtch.lastgroup)))
+    tokens.append((None, None))
+    index = [0]
+
+    def take():
+        t = tokens[index[0]]
+        index[0] += 1
+        return t
+
+    # skip: the value does not matter, as in the right side of 0 && ...
+    def unary(skip):
+        kind, value = take()
+        if kind == 'number':
+            return int(value, 0) if not value.startswith('0') or value == '0' \
+                or value[:2] in ('0x', '0X') else int(value, 8)
+        if kind == 'name' and value == 'defined':
+            kind, value = take()
+            if value == '(':
+                kind, value = take()
+                if take()[1] != ')': raise ValueError('cannot evaluate {}'.format(expr))
+            if kind != 'name': raise ValueError('cannot evaluate {}'.format(expr))
+            return int(value in defines)
+        if kind == 'name':
+            if tokens[index[0]][1] == '(' or depth > 16:
+                raise ValueError('cannot evaluate {}'.format(expr))
+            return cpp_evaluate(defines[value], defines, depth + 1) if value in defines else 0
+        if value == '(':
+            v = binary(0, skip)
+            if take()[1] != ')': raise ValueError('cannot evaluate {}'.format(expr))
+            return v
+        if value == '!': return int(not unary(skip))
+        if value == '-': return -unary(skip)
+        if value == '+': return unary(skip)
+        if value == '~': return ~unary(skip)
+        raise ValueError('cannot evaluate {}'.format(expr))
+
+    def binary(level, skip):
+        left = unary(skip)
+        while tokens[index[0]][1] in _cpp_binary:
+            prec, op = _cpp_binary[tokens[index[0]][1]]
+            if prec <= level: break
+            name = take()[1]
+            right = binary(prec, skip or (name == '&&' and not left) \
+                or (name == '||' and bool(left)))
+            try:
+                left = op(left, right)
+            except ZeroDivisionError:
+                if not skip: raise ValueError('division by zero in {}'.format(expr))
+                left = 0
+        return left
+
+    value = binary(0, False)
+    if tokens[index[0]][0] != None: raise ValueError('cannot evaluate {}'.format(expr))
+    return value
+
+def preprocess(data, defines):
+    """
+    Blank the lines of data in inactive branches of #if, #ifdef, #ifndef,
+    #elif and #else, given the macros defined (a dictionary of their values),
+    and #define and #undef met on the way. If a condition cannot be
+    evaluated, all branches of that #if are kept, so no dependency is lost.
+    """
+    if b'#' not in data or not re_directive.search(data): return data
+    defines = dict(defines)
+    lines = data.split(b'\n')
+    # frames of nested #if: [active, some branch taken, unknown]
+    stack = list()
+    active = True
+    for i, line in enumerate(lines):
+        mtch = re_directive.match(line)
+        if mtch == None:
+            if not active: lines[i] = b''
+            continue
+        lines[i] = b''
+        directive = mtch.group(1).decode('ascii', 'replace')
+        argument = mtch.group(2).decode('ascii', 'replace')
+        words = argument.split()
+        if directive in ('if', 'ifdef', 'ifndef'):
+            if not active:
+                stack.append([False, True, False])
+            else:
+                try:
+                    if directive == 'if': value = bool(cpp_evaluate(argument, defines))
+                    elif not words: raise ValueError(argument)
+                    else: value = (words[0] in defines) == (directive == 'ifdef')
+                    stack.append([value, value, False])
+                except ValueError:
+                    stack.append([True, True, True])
+        elif directive in ('elif', 'else') and stack:
+            frame = stack[-1]
+            enclosing = all(f[0] for f in stack[:-1])
+            if frame[2] or not enclosing:
+                frame[0] = frame[2]
+            elif frame[1]:
+                frame[0] = False
+            elif directive == 'else':
+                frame[0] = frame[1] = True
+            else:
+                try:
+                    frame[0] = frame[1] = bool(cpp_evaluate(argument, defines))
+                except ValueError:
+                    frame[0] = frame[2] = True
+        elif directive == 'endif' and stack:
+            stack.pop()
+        elif directive == 'define' and active and words:
+            name = words[0].split('(')[0]
+            defines[name] = argument[len(words[0]):].strip() or '1' \
+                if '(' not in words[0] else '1'
+        elif directive == 'undef' and active and words:
+            defines.pop(words[0], None)
+        elif not active:
+            continue
+        else:
+            # other directives (#include, #line...) are kept
+            lines[i] = line
+        active = all(f[0] for f in stack)
+    return b'\n'.join(lines)
 
 #------------------------------------------------------------------------------#
 
-def parse_source(f, objfil):
-    global universe
+def scan_source(data, encoding = 'utf-8', defines = None):
+    """
+    Scan the contents of a Fortran source and return a list of records, one
+    per program unit: (type, name, parent, uses, includes). The records are
+    plain tuples, so they can be passed between processes and stored.
+    If defines are given (macro -> value), lines in inactive branches of
+    preprocessor conditionals are skipped (see preprocess).
+
+    The whole buffer is searched at once for statements of interest and only
+    matched names are decoded, so the encoding of the rest does not matter.
+    """
+    if hasattr(data, 'read'): data = data.read()
+    if isinstance(data, str): data = data.encode(encoding, 'surrogateescape')
+    if defines != None: data = preprocess(data, defines)
+    records = list()
     # when module name is found, it will be set here
     current_module = None
-    for line in f:
+    for mtch in re_statement.finditer(data):
         # check if we are outside the module
         if current_module == None:
-            # try to match the module line
-            mtch = re.match(re_module, line)
             # is this a module line? (module, program, etc)
-            if mtch:
-                mtype, mparent, mname = mtch.groups()
-                if mtype.lower() == 'program':
-                    current_module = Program(mname, objfil)
-                    universe.add(current_module)
-                    if verbose: stderr.write(u'+ program {}\n'.format(mname))
-                elif mtype.lower() == 'module':
-                    # search for blank modules in the universe before adding
-                    current_module = query_modules_or_new(mname)
-                    current_module.assign_object_file(objfil)
-                    if verbose: stderr.write(u'+ module {}\n'.format(mname))
-                elif mparent != None:
-                    # for submodules, first search if parent is defined
-                    parent_module = query_modules_or_new(mparent)
-                    # search for blank modules in the universe before adding
-                    current_module = query_modules_or_new(mname)
-                    current_module.assign_object_file(objfil)
-                    current_module.deps.add(parent_module)
-                    parent_module.submodules.add(current_module)
-                    if verbose: stderr.write(u'+ module {}, submodule of {}\n'.format(mname, mparent))
-                else: raise Exception("wtf")
-            # if not, try to match use statement. it could be anonymous program
-            # mtch = re.match(re_use, line)
-            # if mtch:
-            #     log('anonymous program in ' + objfil.fnsrc, 2)
-            #     # create program unit
-            #     current_module = Program('program_' + objfil.fnexe, objfil)
-            #     universe.add(current_module)
-            #     # add the module as dependency
-            #     mdep = query_modules_or_new(mtch.group(1))
-            #     current_module.deps.add(mdep)
+            mtype = mtch.group('unit')
+            if mtype == None: continue
+            mname = mtch.group('name').decode('ascii')
+            mtype = mtype[:1].lower()
+            if mtype == b'p':
+                current_module = ('program', mname, None, [], [])
+            elif mtype == b'm':
+                current_module = ('module', mname, None, [], [])
+            else:
+                # for "submodule (ancestor:parent) name", parent is the last
+                mparent = mtch.group('parent2') or mtch.group('parent')
+                current_module = ('submodule', mname, mparent.decode('ascii'), [], [])
+            records.append(current_module)
         # we are inside the module
         else:
-            # two things can happen: "use" statement, include or unit end
-
-            # try to match unit end
-            if re.match(re_module_end, line):
+            # three things can happen: "use" statement, include or unit end
+            kind = mtch.lastgroup
+            if kind == 'end':
                 # we are going out of the module
                 current_module = None
-                continue
-
-            # attempt to match "use"
-            mtch = re.match(re_use, line)
-            if mtch:
-                # use statement matched; add as dependency
-                mdep = query_modules_or_new(mtch.group(1))
-                current_module.deps.add(mdep)
-                if verbose: stderr.write('* {} uses {}\n'.format(current_module, mdep))
-                continue
+            elif kind == 'use':
+                current_module[3].append(mtch.group('use').decode('ascii'))
+            elif kind == 'include':
+                current_module[4].append(mtch.group('include') \
+                    .decode(encoding, 'surrogateescape'))
+    return records
 
-            # attempt to match "include"
-            mtch = re.match(re_include, line)
-            if mtch:
-                current_module.includes.add(mtch.group(1))
-                if verbose: stderr.write('* {} includes {}\n'.format(current_module, mtch.group(1)))
-                continue
-
-#------------------------------------------------------------------------------#
 #------------------------------------------------------------------------------#
 
-def parse_cmdline_args():
-    from sys import argv
-    from argparse import ArgumentParser
+def scan_file(filepath, encoding = 'utf-8', cached = None, defines = None):
+    """
+    Scan a file and return its cache entry: [mtime, size, digest, records].
+    If the content of the file is the same as in the cached entry, records
+    are taken from there instead of scanning the file again.
+    """
+    return scan_file_timed(filepath, encoding, cached, defines)[0]
+
+def scan_file_timed(filepath, encoding = 'utf-8', cached = None, defines = None):
+    """
+    Same as scan_file, returning also seconds spent reading and parsing
+    the file and the number of lines: (entry, read, parse, lines).
+    """
+    from hashlib import sha1
+    from time import time_ns, perf_counter
+    t0 = perf_counter()
+    st = stat(filepath)
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    digest = sha1(data).hexdigest()
+    t1 = perf_counter()
+    if cached and cached[2] == digest:
+        records = cached[3]
+    else:
+        records = scan_source(data, encoding,
+            defines if re_preprocessed.search(filepath) else None)
+    t2 = perf_counter()
+    # if the file was modified just now, it could be modified again without
+    # changing mtime; do not trust mtime then and compare the content next time
+    mtime = st.st_mtime_ns if st.st_mtime_ns < time_ns() - 2000000000 else None
+    return [mtime, st.st_size, digest, records], t1 - t0, t2 - t1, data.count(b'\n')
 
-    parser = ArgumentParser('fortdep2')
-    parser.add_argument('--programs', '-p', action = 'store_true',
-            help = 'generate dependencies for programs')
-    parser.add_argument('--no-includes', '-i', action = 'store_true',
-            help = 'don\'t generate dependencies from includes')
-    parser.add_argument('--scaffold', '-s', action = 'store_true', dest = 'whole',
-            help = 'generate entire makefile')
-    parser.add_argument('--verbose', '-v', action = 'store_true',
-            help = 'more info')
-    parser.add_argument('--encoding', '-e', type = str, default = 'utf-8',
-            dest = 'encoding', help = 'specify input encoding (default: utf-8)')
-    parser.add_argument('--output', '-o',
-            type = str, default = '--',
-            help = 'write output to file')
-    parser.add_argument('path', nargs='*')
+#------------------------------------------------------------------------------#
 
-    return parser.parse_args(argv[1:])
+class ParseCache(object):
+    """
+    On-disk cache of scan results, keyed by the path of the file. Entries
+    are valid when mtime and size of the file did not change; otherwise the
+    file is read again and records are reused only if the content hash
+    matches. The whole cache is dropped if the key (version of fortdep and
+    the options affecting the scan) is different.
+    """
+    def __init__(self, filename, key):
+        import json
+        self.filename = filename
+        self.key = key
+        self.entries = dict()
+        self.values = dict()
+        self.modified = False
+        # without file name, the cache is only kept in memory
+        if filename == None: return
+        try:
+            with open(filename, 'r', encoding = 'utf-8') as f:
+                data = json.load(f)
+            if data.get('key') == key:
+                self.entries = data['files']
+                self.values = data.get('values', dict())
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, filepath):
+        return self.entries.get(filepath)
+
+    def get_value(self, name):
+        return self.values.get(name)
+
+    def set_value(self, name, value):
+        if self.values.get(name) != value:
+            self.values[name] = value
+            self.modified = True
+
+    def is_fresh(self, filepath):
+        entry = self.entries.get(filepath)
+        if entry == None or entry[0] == None: return False
+        st = stat(filepath)
+        return entry[0] == st.st_mtime_ns and entry[1] == st.st_size
+
+    def update(self, filepath, entry):
+        if self.entries.get(filepath) != entry:
+            self.entries[filepath] = entry
+            self.modified = True
+
+    def save(self, filepaths):
+        """write the cache, keeping only entries for given files"""
+        import json
+        from os import replace, remove
+        keep = set(filepaths)
+        if len(keep) != len(self.entries):
+            self.entries = dict((k, v) for k, v in self.entries.items() if k in keep)
+            self.modified = True
+        if not self.modified or self.filename == None: return
+        self.modified = False
+        data = dict(key = self.key, values = self.values, files = self.entries)
+        tmp = '{}.{}.tmp'.format(self.filename, getpid())
+        try:
+            with open(tmp, 'w', encoding = 'utf-8') as f:
+                json.dump(data, f, separators = (',', ':'))
+            replace(tmp, self.filename)
+        except OSError as e:
+            stderr.write('warning: cannot write cache {}: {}\n'.format(self.filename, e))
+            if path.exists(tmp): remove(tmp)
 
 #------------------------------------------------------------------------------#
 
@@ -222,109 +732,2088 @@ def check_makefile_vpath():
     return re.split(r'[:\s]', mkoutp) if mkoutp else None
 
 #------------------------------------------------------------------------------#
+
+re_make_assign = LazyRegex(r'^(?:(?:override|export)\s+)*([^\s:#=?+!$]+)\s*(:::=|::=|:=|\?=|\+=|!=|=)\s*(.*)$')
+re_make_include = LazyRegex(r'^(-include|sinclude|include)\s+(.*)$')
+re_make_conditional = LazyRegex(r'^(ifeq|ifneq|ifdef|ifndef|else|endif)\b')
+re_make_ref = LazyRegex(r'\$(?:\(([^()]*)\)|\{([^{}]*)\}|(.))')
+# variables which make defines itself; CURDIR is the only one known here
+re_make_builtin = LazyRegex(r'^(\..+|MAKE.*|MFLAGS|GNUMAKEFLAGS|SHELL|SUFFIXES)$')
+
+class MakefileError(Exception):
+    pass
+
+def _make_expand(value, variables, depth = 0, reached = None):
+    """
+    expand references to variables, like make does for simple cases; the
+    names of the variables met on the way are added to reached, if given
+    """
+    def expand_ref(mtch):
+        name = mtch.group(1) or mtch.group(2) or mtch.group(3)
+        if name == '$': return '$'
+        if depth > 20 or ' ' in name or ',' in name or '$' in name:
+            raise MakefileError('cannot evaluate $({})'.format(name))
+        if name not in variables and re_make_builtin.match(name):
+            raise MakefileError('{} is defined by make'.format(name))
+        if reached != None: reached.add(name)
+        flavor, value = variables.get(name, ('simple', environ.get(name, '')))
+        if flavor == 'shell': raise MakefileError('{} is set by shell'.format(name))
+        return _make_expand(value, variables, depth + 1, reached) \
+            if flavor == 'recursive' else value
+    return re_make_ref.sub(expand_ref, value)
+
+def _make_read(filename, variables, conditioned, included = None):
+    """
+    Read the assignments of filename into variables (name -> (flavor,
+    value)); names assigned inside conditionals, or from variables which
+    are, are added to conditioned, since only make knows their value.
+    """
+    included = included if included != None else set()
+    if filename in included: return
+    included.add(filename)
+    conditional = 0
+    with open(filename, 'r', encoding = 'utf-8', errors = 'replace') as f:
+        text = f.read().replace('\\\n', ' ')
+    for line in text.split('\n'):
+        # recipes are not interesting, and neither are comments
+        if line.startswith('\t'): continue
+        line = re.sub(r'(?<!\\)#.*$', '', line).strip()
+        mtch = re_make_conditional.match(line)
+        if mtch:
+            if mtch.group(1).startswith('if'): conditional += 1
+            elif mtch.group(1) == 'endif': conditional -= 1
+            continue
+        mtch = re_make_include.match(line)
+        if mtch:
+            for fn in _make_expand(mtch.group(2), variables).split():
+                if path.isfile(fn): _make_read(fn, variables, conditioned, included)
+            continue
+        mtch = re_make_assign.match(line)
+        if not mtch: continue
+        name, op, value = mtch.groups()
+        if name == 'VPATH' and conditional > 0:
+            raise MakefileError('VPATH is set conditionally')
+        if conditional > 0: conditioned.add(name)
+        flavor, old = variables.get(name, (None, None))
+        reached = set()
+        if op == '!=':
+            variables[name] = ('shell', value)
+        elif op == '?=':
+            if flavor == None and name not in environ:
+                variables[name] = ('recursive', value)
+        elif op == '+=' and flavor != None:
+            if flavor != 'recursive': value = _make_expand(value, variables, reached = reached)
+            variables[name] = (flavor, (old + ' ' + value).strip())
+        elif op in ('=', '+='):
+            variables[name] = ('recursive', value)
+        else:
+            variables[name] = ('simple', _make_expand(value, variables, reached = reached))
+        # a simple variable keeps the value of a conditional one
+        if reached & conditioned: conditioned.add(name)
+
+def find_makefile():
+    for fn in ('GNUmakefile', 'makefile', 'Makefile'):
+        if path.isfile(fn): return fn
+
+def read_makefile_vpath(cache = None, log = None):
+    """
+    Read VPATH from the makefile in the current directory. The makefile is
+    parsed directly; only if VPATH, or a variable it refers to, is set in a
+    way that cannot be evaluated without make (functions, shell,
+    conditionals), make is run, and its answer is kept in the cache until
+    the makefile changes.
+    """
+    makefile = find_makefile()
+    if makefile == None:
+        vpath = environ.get('VPATH', '')
+    else:
+        variables = dict(CURDIR = ('simple', getcwd()))
+        conditioned = set()
+        try:
+            _make_read(makefile, variables, conditioned)
+            reached = set()
+            vpath = _make_expand('$(VPATH)', variables, reached = reached)
+            if reached & conditioned:
+                raise MakefileError('VPATH depends on {}, set conditionally'.format(
+                    ', '.join(sorted(reached & conditioned))))
+        except MakefileError as e:
+            st = stat(makefile)
+            key = [makefile, st.st_mtime_ns, st.st_size]
+            cached = cache.get_value('make-vpath') if cache else None
+            if cached and cached[0] == key: return cached[1]
+            if log: log.write('{}: {}, running make\n'.format(makefile, e))
+            result = check_makefile_vpath()
+            if cache: cache.set_value('make-vpath', [key, result])
+            return result
+    return [ d for d in re.split(r'[:\s]', vpath) if d ] or None
+
 #------------------------------------------------------------------------------#
 
-def main():
-    global universe, objfiles, verbose
+# patterns in .fortdepignore syntax (same as .gitignore) which are ignored by
+# default when scanning directories recursively: hidden directories and
+# typical build directories
+default_ignore = [ '.*/', 'build/', '_build/', 'CMakeFiles/', '__pycache__/' ]
+
+class IgnoreRules(object):
+    """
+    Patterns in .gitignore syntax. Each pattern applies to paths below the
+    directory it was defined in; the last matching pattern decides.
+    """
+    def __init__(self, patterns = (), base = ''):
+        self.rules = list()
+        for p in patterns: self.add(p, base)
+
+    def add(self, pattern, base = ''):
+        from fnmatch import translate
+        pattern = pattern.rstrip('\n').rstrip()
+        if not pattern or pattern.startswith('#'): return
+        negate = pattern.startswith('!')
+        if negate: pattern = pattern[1:]
+        dironly = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        if not pattern: return
+        self.rules.append((base, re.compile(translate(pattern)),
+            negate, dironly, anchored))
+
+    def read(self, filename, base = ''):
+        try:
+            with open(filename, 'r', encoding = 'utf-8', errors = 'replace') as f:
+                for line in f: self.add(line, base)
+        except OSError:
+            pass
+
+    def ignored(self, relpath, isdir = False):
+        """relpath is relative to current directory, separated with /"""
+        result = False
+        for base, regex, negate, dironly, anchored in self.rules:
+            if result == (not negate): continue
+            if dironly and not isdir: continue
+            if base:
+                if not relpath.startswith(base + '/'): continue
+                p = relpath[len(base) + 1:]
+            else:
+                p = relpath
+            if regex.match(p if anchored else p.rsplit('/', 1)[-1]):
+                result = not negate
+        return result
 
-    #--------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
 
-    # main program starts here: parse command line args
-    args = parse_cmdline_args()
+def _relpath(reldir, name):
+    return name if reldir == '.' else reldir + '/' + name
+
+def find_sources(folders = None, exclude = (), pattern = re_fortext):
+    """
+    Find source files matching pattern. If folders are given, files directly
+    in them are taken. Otherwise, the current directory is searched
+    recursively, skipping hidden and build directories. Paths matching
+    the exclude patterns or .fortdepignore files are skipped.
+    Returns a list of (directory, [file names]).
+    """
+    rules = IgnoreRules(default_ignore if folders == None else ())
+    rules.read('.fortdepignore')
+    for p in exclude: rules.add(p)
+
+    def listing(reldir):
+        files, subdirs = list(), list()
+        with scandir(reldir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirs.append(entry.name)
+                elif pattern.search(entry.name) and entry.is_file() \
+                        and not rules.ignored(_relpath(reldir, entry.name)):
+                    files.append(entry.name)
+        return files, subdirs
+
+    if folders != None:
+        return [ (folder, listing(folder)[0]) for folder in folders ]
+
+    # depth-first, in the same order as os.walk would do
+    result = list()
+    stack = ['.']
+    while stack:
+        reldir = stack.pop()
+        if reldir != '.':
+            rules.read(path.join(reldir, '.fortdepignore'), reldir)
+        files, subdirs = listing(reldir)
+        result.append((reldir, files))
+        for d in reversed(subdirs):
+            d = _relpath(reldir, d)
+            if not rules.ignored(d, True): stack.append(d)
+    return result
 
-    # if no output file given, write to stdout
-    output = stdout if args.output == '--' else open(args.output, 'w')
+#------------------------------------------------------------------------------#
 
-    verbose = args.verbose
+class IncludeResolver(object):
+    """
+    Finds included files as the compiler does: in the directory of the
+    including file, then in the search paths (-I). Each directory is listed
+    once, so that looking a file up is a set membership test. Included files
+    are scanned once, however many files include them, for the files they
+    include in turn and the modules they use.
+    """
+    def __init__(self, search = (), encoding = 'utf-8'):
+        self.search = list(search)
+        self.encoding = encoding
+        self.listings = dict()
+        self.found = dict()
+        # included file -> (files it includes, directly or not, modules used there)
+        self.closures = dict()
+
+    def listing(self, directory):
+        entries = self.listings.get(directory)
+        if entries == None:
+            from os import listdir
+            try:
+                entries = frozenset(listdir(directory or '.'))
+            except OSError:
+                entries = frozenset()
+            self.listings[directory] = entries
+        return entries
+
+    def find(self, name, directory):
+        """path of the file included from given directory, or None"""
+        key = (directory, name)
+        if key not in self.found:
+            self.found[key] = None
+            for d in [directory] + self.search:
+                fp = path.normpath(path.join(d, name))
+                parent, base = path.split(fp)
+                if base in self.listing(parent) and path.isfile(fp):
+                    self.found[key] = fp
+                    break
+        return self.found[key]
+
+    def scan(self, filepath):
+        """names of files included and of modules used anywhere in a file"""
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        includes, uses = list(), list()
+        for mtch in re_statement.finditer(data):
+            if mtch.lastgroup == 'include':
+                includes.append(mtch.group('include').decode(self.encoding, 'surrogateescape'))
+            elif mtch.lastgroup == 'use':
+                uses.append(mtch.group('use').decode('ascii'))
+        return includes, uses
+
+    def closure(self, filepath):
+        if filepath not in self.closures:
+            # an empty result for now, should the file include itself
+            self.closures[filepath] = (frozenset(), frozenset())
+            try:
+                includes, used = self.scan(filepath)
+            except OSError:
+                includes, used = (), ()
+            files, uses = self.resolve(includes, path.dirname(filepath))
+            self.closures[filepath] = (frozenset(files), frozenset(uses.union(used)))
+        return self.closures[filepath]
+
+    def resolve(self, names, directory):
+        """
+        Files included (given names included from a file in directory), with
+        the files they include, and modules used in all of them. Names which
+        are not found are given as they are.
+        """
+        files, uses = set(), set()
+        for name in names:
+            fp = self.find(name, directory)
+            if fp == None:
+                files.add(name)
+                continue
+            files.add(fp)
+            f, u = self.closure(fp)
+            files |= f
+            uses |= u
+        return files, uses
 
-    make_vpath = None
+#------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
+
+def scan_files(filepaths, encoding = 'utf-8', cache = None, jobs = 1, log = None,
+        stats = None, defines = None):
+    """
+    Return cache entries for given files. Only files which changed since
+    they were cached are scanned, in parallel if jobs is not 1. If stats
+    are given, the files scanned are recorded there. Defines are passed
+    to scan_source for files to be preprocessed.
+    """
+    filepaths = list(filepaths)
+    # files which did not change since the last run are not read at all
+    entries = [ cache.get(fp) if cache else None for fp in filepaths ]
+    stale = [ i for i, fp in enumerate(filepaths) \
+            if not (cache and cache.is_fresh(fp)) ]
+    stale_paths = [ filepaths[i] for i in stale ]
+    stale_entries = [ entries[i] for i in stale ]
+
+    if jobs != 1 and len(stale) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from itertools import repeat
+        from os import cpu_count
+        jobs = jobs if jobs > 0 else cpu_count()
+        with ProcessPoolExecutor(jobs) as pool:
+            scanned = list(pool.map(scan_file_timed, stale_paths, repeat(encoding),
+                stale_entries, repeat(defines), chunksize = max(1, len(stale) // (8 * jobs))))
+    else:
+        scanned = [ scan_file_timed(fp, encoding, e, defines) \
+                for fp, e in zip(stale_paths, stale_entries) ]
+
+    if stats:
+        for fp, (entry, t_read, t_parse, lines) in zip(stale_paths, scanned):
+            stats.file(fp, t_read, t_parse, entry[1], lines)
+    scanned = [ s[0] for s in scanned ]
+
+    for i, entry in zip(stale, scanned):
+        entries[i] = entry
+        if cache: cache.update(filepaths[i], entry)
+    if cache: cache.save(filepaths)
+    if log: log.write('{} of {} files scanned\n'.format(len(stale), len(filepaths)))
+    return entries
+
+#------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
+
+class Stats(object):
+    """
+    Instrumentation of a run: time spent in each phase, counts of what was
+    processed and the slowest files.
+
+        stats = Stats()
+        with stats.phase('discovery'):
+            ...
+        stats.count('files', 120)
+        stats.write(stderr, 'json')
+    """
+    def __init__(self):
+        from time import perf_counter
+        self.clock = perf_counter
+        self.started = perf_counter()
+        # phases in order of first appearance: name -> seconds
+        self.phases = dict()
+        self.counts = dict()
+        # scanned files: (seconds reading, seconds parsing, path, bytes, lines)
+        self.files = list()
+
+    def phase(self, name):
+        """context manager adding the time spent inside to the phase"""
+        from contextlib import contextmanager
+        @contextmanager
+        def timer():
+            t = self.clock()
+            try:
+                yield
+            finally:
+                self.phases[name] = self.phases.get(name, 0.0) + self.clock() - t
+        return timer()
+
+    def count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def file(self, filepath, t_read, t_parse, size, lines):
+        self.files.append((t_read, t_parse, filepath, size, lines))
+        self.count('files_scanned')
+        self.count('lines_scanned', lines)
+
+    def report(self, slowest = 10):
+        """everything as a dictionary (for JSON)"""
+        files = sorted(self.files, key = lambda f: -(f[0] + f[1]))[:slowest]
+        return dict(
+            phases = dict(self.phases),
+            total = self.clock() - self.started,
+            reading = sum(f[0] for f in self.files),
+            parsing = sum(f[1] for f in self.files),
+            counts = dict(self.counts),
+            slowest = [ dict(file = f[2], read = f[0], parse = f[1], bytes = f[3],
+                lines = f[4]) for f in files ],
+        )
+
+    def write(self, output, format = 'text', slowest = 10):
+        r = self.report(slowest)
+        if format == 'json':
+            import json
+            json.dump(r, output, sort_keys = True)
+            output.write('\n')
+            return
+        output.write('stats: {}\n'.format(' '.join('{}={}'.format(k, v) \
+            for k, v in sorted(r['counts'].items()))))
+        for name, t in r['phases'].items():
+            output.write('  {:12s} {:8.3f} s\n'.format(name, t))
+        output.write('  {:12s} {:8.3f} s\n'.format('total', r['total']))
+        if self.files:
+            output.write('  reading {:.3f} s, parsing {:.3f} s in {} files{}\n'.format(
+                r['reading'], r['parsing'], len(self.files),
+                ' (summed over processes)' if self.counts.get('jobs', 1) != 1 else ''))
+        if r['slowest']:
+            output.write('  slowest files:\n')
+        for f in r['slowest']:
+            output.write('  {:8.4f} s {} ({} bytes, {} lines)\n'.format(
+                f['read'] + f['parse'], f['file'], f['bytes'], f['lines']))
+
+#------------------------------------------------------------------------------#
+
+def load_manifest(filename):
+    """read a manifest of a prebuilt library (written by the 'manifest' emitter)"""
+    import json
+    with open(filename, 'r', encoding = 'utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or 'fortdep_manifest' not in data \
+            or not isinstance(data.get('modules'), dict):
+        raise Exception('{} is not a fortdep manifest'.format(filename))
+    return data
+
+def load_fragment(filename):
+    """read a fragment of a graph (written by the 'fragment' emitter)"""
+    import json
+    with open(filename, 'r', encoding = 'utf-8') as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            data = None
+    if not isinstance(data, dict) or 'fortdep_fragment' not in data \
+            or not isinstance(data.get('files'), list):
+        raise Exception('{} is not a fortdep fragment'.format(filename))
+    if data.get('format') != cache_format:
+        raise Exception('{} was written by another version of fortdep'.format(filename))
+    return data
+
+def find_manifests(dirs):
+    """manifests (name.fortdep.json) in given directories, sorted by name"""
+    found = list()
+    for d in dirs:
+        try:
+            found.extend(sorted(entry.path for entry in scandir(d) \
+                if entry.name.endswith(manifest_suffix)))
+        except OSError:
+            pass
+    return found
+
+#------------------------------------------------------------------------------#
+
+class DependencyGraph(object):
+    """
+    Dependencies between Fortran sources. Sources are added from files,
+    directories or directly as content; then the graph can be queried or
+    written out by one of the emitters. Graphs are independent of each
+    other, so any number of them can be used at the same time.
+
+        graph = DependencyGraph()
+        graph.add_paths(['src'])
+        graph.add_source('main.f90', 'program main\n use m1\nend program\n')
+        graph.provider('m1')            # -> SourceFile of m1.f90
+        graph.emit(stdout, 'make', programs = True)
+    """
+
+    def __init__(self, encoding = 'utf-8', verbose = False, log = stderr, stats = None,
+            include_path = (), defines = None):
+        self.universe = Universe()
+        # if given, phases of building the graph are timed there (see Stats)
+        self.stats = stats
+        # source files in order of adding
+        self.objfiles = list()
+        self.encoding = encoding
+        # macros for preprocessor conditionals in .F* files (None: all
+        # branches are scanned)
+        self.defines = defines
+        self.verbose = verbose
+        # warnings (and with verbose, progress) are written here
+        self.log = log
+        self._closures = None
+        self._reverse = None
+        self._archives = None
+        # modules of prebuilt libraries: name -> (library, manifest)
+        self.external = dict()
+        # included files are found in these directories (after the one
+        # of the including file)
+        self.resolver = IncludeResolver(include_path, encoding)
 
     #--------------------------------------------------------------------------#
+    # building the graph
+
+    def add_records(self, fnsrc, records, filepath = None):
+        """add units scanned from file fnsrc; returns its SourceFile"""
+        obj = SourceFile(fnsrc, filepath)
+        obj.records = records
+        # the graph is left unchanged if the file cannot be added
+        self.universe.check(records, obj)
+        self.objfiles.append(obj)
+        self._closures = None
+        self._reverse = None
+        self._archives = None
+        self.universe.merge(records, obj, self.log if self.verbose else None)
+        # included files are given by their paths, together with the files
+        # they include; modules used in them are used by the unit
+        directory = path.dirname(filepath) if filepath else ''
+        for u in obj.units:
+            if not u.includes: continue
+            files, uses = self.resolver.resolve(u.includes, directory)
+            u.includes = files
+            for name in uses:
+                m = self.universe.query_modules_or_new(name)
+                if m is not u: u.deps.add(m)
+        return obj
+
+    def add_source(self, fnsrc, content):
+        """add a source with given content (bytes or str)"""
+        return self.add_records(fnsrc, scan_source(content, self.encoding,
+            self.defines if re_preprocessed.search(fnsrc) else None))
+
+    def add_files(self, filepaths, cache = None, jobs = 1):
+        """add sources from given files, using and updating the cache"""
+        from contextlib import nullcontext
+        stats = self.stats
+        filepaths = list(filepaths)
+        with stats.phase('scanning') if stats else nullcontext():
+            entries = scan_files(filepaths, self.encoding, cache, jobs,
+                self.log if self.verbose else None, stats, self.defines)
+        # records are merged in the order of files, so that the result (and
+        # any error about duplicate modules) does not depend on the scanning
+        with stats.phase('graph') if stats else nullcontext():
+            for fp, entry in zip(filepaths, entries):
+                self.add_records(path.basename(fp), entry[3], fp)
+        if stats:
+            stats.count('files', len(filepaths))
+            stats.count('bytes', sum(entry[1] for entry in entries))
+
+    def add_paths(self, folders = None, exclude = (), cache = None, jobs = 1):
+        """
+        Add sources found in given directories, or recursively in
+        the current directory (see find_sources).
+        """
+        self.add_files((path.join(reldir, fn) for reldir, filelist \
+            in find_sources(folders, exclude) for fn in filelist), cache, jobs)
+
+    def add_fragment(self, filename):
+        """
+        Add sources scanned elsewhere, from a fragment (see the 'fragment'
+        emitter). Fragments of parts of a tree (shards), added in the order
+        the whole tree would be scanned, give the same graph as the whole.
+        """
+        from contextlib import nullcontext
+        data = load_fragment(filename)
+        with self.stats.phase('graph') if self.stats else nullcontext():
+            for fp, records in data['files']:
+                self.add_records(path.basename(fp), records, fp)
+        if self.stats:
+            self.stats.count('files', len(data['files']))
+            self.stats.count('fragments')
+        if self.verbose and self.log:
+            self.log.write('{}: {} files\n'.format(filename, len(data['files'])))
+
+    def add_manifest(self, filename):
+        """
+        Add modules of a prebuilt library from its manifest (see the
+        'manifest' emitter), so that using them is not an error.
+        """
+        data = load_manifest(filename)
+        library = data.get('library')
+        if library and not library.startswith('-') and not path.isabs(library):
+            # relative to the manifest, if it is there
+            located = path.join(path.dirname(filename), library)
+            if path.exists(located): library = located
+        for name in data['modules']:
+            self.external.setdefault(intern(name.lower()), (library, filename))
+        if self.verbose and self.log:
+            self.log.write('{}: {} modules\n'.format(filename, len(data['modules'])))
+
+    def add_manifests(self, filenames = (), dirs = ()):
+        """add given manifests and all manifests found in directories"""
+        for fn in list(filenames) + find_manifests(dirs):
+            self.add_manifest(fn)
+
+    def warn(self, message):
+        if self.log: self.log.write('warning: {}\n'.format(message))
 
-    # scan for files, either from makefile VPATH or just recursively
-    if len(args.path) == 0:
-        make_vpath = check_makefile_vpath()
-        if make_vpath:
-            stderr.write('found Makefile, using directories: {}\n'.format(", ".join(make_vpath)))
-            inp = [ (folder, [ f for f in listdir(folder)       \
-                    if path.isfile(path.join(folder,f)) ])      \
-                    for folder in make_vpath ]
+    #--------------------------------------------------------------------------#
+    # queries
+
+    def module(self, name):
+        return self.universe.query_modules(name)
+
+    def provider(self, name):
+        """SourceFile where the module is defined, or None"""
+        m = self.universe.query_modules(name)
+        return m.objfile if m else None
+
+    def programs(self):
+        return [ p for p in self.universe.programs if p.objfile != None ]
+
+    def program(self, name):
+        """program by its name or name of the executable"""
+        p = self.universe.query_programs(name)
+        if p != None: return p
+        for p in self.universe.programs:
+            if p.objfile != None and p.objfile.fnexe == name: return p
+
+    def missing(self):
+        """
+        Modules which are used, but not defined in any file, nor intrinsic,
+        nor in any of the libraries.
+        """
+        return [ m for m in self.universe.modules.values() if m.objfile == None \
+            and m.name not in intrinsic_modules and m.name not in self.external ]
+
+    def libraries(self, p):
+        """prebuilt libraries with modules used by program p"""
+        if not isinstance(p, Program): p = self.program(p)
+        return set(self.external[d.name][0] for x in self.closures()[p] for d in x.deps \
+            if d.objfile == None and d.name in self.external and self.external[d.name][0])
+
+    def cycles(self):
+        return use_cycles(self.universe)
+
+    def prerequisites(self, u, includes = True, interfaces = False, moddir = None):
+        """
+        Prerequisites of the object file of unit u. With interfaces, module
+        files (.mod, .smod for submodules) of used modules are given instead
+        of their object files.
+        """
+        if interfaces:
+            parent = parent_module(u)
+            deps = set()
+            for x in u.deps:
+                if x.objfile == None or x.objfile.fnobj == u.objfile.fnobj: continue
+                f = smod_file(x) if x == parent else x.name + '.mod'
+                deps.add(path.join(moddir, f) if moddir else f)
         else:
-            stderr.write(u'no directories given; scanning recursively...\n')
-            cwd = getcwd()
-            inp = [ (path.relpath(fd,cwd),fl) for fd,lf,fl in walk(cwd) ]
-    else:
-        inp = [ (folder, [ f for f in listdir(folder)       \
-                if path.isfile(path.join(folder,f)) ])      \
-                for arg in args.path for folder in arg.split(':')  ]
+            deps = set(x.objfile.fnobj for x in u.deps if x.objfile != None)
+            deps.discard(u.objfile.fnobj)
+        if includes: deps |= u.includes
+        return deps
+
+    def object_dependencies(self, includes = True, interfaces = False, moddir = None):
+        """dictionary: object file -> set of its prerequisites"""
+        objects = dict()
+        for obj in self.objfiles:
+            if not obj.units: continue
+            deps = objects.setdefault(obj.fnobj, set())
+            for u in obj.units: deps |= self.prerequisites(u, includes, interfaces, moddir)
+        return objects
+
+    def dependents(self, includes = True):
+        """dictionary: object (or included file) -> set of objects using it"""
+        users = dict()
+        for obj, deps in self.object_dependencies(includes).items():
+            for d in deps: users.setdefault(d, set()).add(obj)
+        return users
+
+    def closures(self):
+        """dictionary: program -> set of units it must be linked with"""
+        if self._closures == None:
+            self._closures = UnitGraph(self.universe).closures(self.programs())
+        return self._closures
+
+    def link_objects(self, p):
+        """object files linked into program p"""
+        if not isinstance(p, Program): p = self.program(p)
+        return set(x.objfile.fnobj for x in self.closures()[p] if x.objfile != None)
+
+    def _archive_layout(self):
+        if self._archives == None:
+            # objects of each directory, except objects of programs
+            directories = dict()
+            for obj in self.objfiles:
+                if not obj.units or any(isinstance(u, Program) for u in obj.units): continue
+                d = path.normpath(path.dirname(obj.filepath or obj.fnsrc) or '.')
+                directories.setdefault(d, list()).append(obj)
+            names = sorted(directories)
+            index = dict((d, i) for i, d in enumerate(names))
+            dir_of = dict((obj, index[d]) for d, objs in directories.items() for obj in objs)
+            edges = [ set() for d in names ]
+            for obj, i in dir_of.items():
+                for u in obj.units:
+                    for x in linked_units(u):
+                        j = dir_of.get(x.objfile)
+                        if j != None and j != i: edges[i].add(j)
+            # directories needing each other share one archive, so that the
+            # archives can be given to the linker in order, each just once:
+            # before the archives it needs
+            members, order, archive_of = dict(), list(), dict()
+            for c in reversed(strongly_connected([ sorted(e) for e in edges ])):
+                dirs = [ names[i] for i in sorted(c) ]
+                if len(dirs) == 1:
+                    a = archive_name(dirs[0])
+                else:
+                    try:
+                        a = archive_name(path.commonpath(dirs))
+                    except ValueError:
+                        a = archive_name('.')
+                base, n = a[:-2], 1
+                while a in members:
+                    n += 1
+                    a = '{}_{}.a'.format(base, n)
+                members[a] = set()
+                order.append(a)
+                for d in dirs:
+                    for obj in directories[d]:
+                        members[a].add(obj.fnobj)
+                        archive_of[obj] = a
+            self._archives = (members, order, archive_of)
+        return self._archives
+
+    def archives(self):
+        """
+        Static libraries with the objects of each directory, except objects
+        of programs: name -> set of objects. Directories which need each
+        other (through modules used or linked) share one library, named
+        after the directory containing them (see archive_name).
+        """
+        return self._archive_layout()[0]
+
+    def link_archives(self, p):
+        """
+        What program p is linked from when objects are in archives: its own
+        objects, then the archives it needs, each before the archives it
+        needs in turn (as the linker reads them once).
+        """
+        if not isinstance(p, Program): p = self.program(p)
+        members, order, archive_of = self._archive_layout()
+        objects, needed = set(), set()
+        for x in self.closures()[p]:
+            if x.objfile == None: continue
+            a = archive_of.get(x.objfile)
+            if a == None: objects.add(x.objfile.fnobj)
+            else: needed.add(a)
+        return sorted(objects) + [ a for a in order if a in needed ]
+
+    def reverse_index(self):
+        """
+        Reverse adjacency of source files: files using modules of each
+        file (compiled again when it changes), files linked together with
+        units of each file (linked again when it changes) and files which
+        include a given file: by its path if the file was found, by
+        (None, its name) if not.
+        """
+        if self._reverse == None:
+            users, linkers, includers = dict(), dict(), dict()
+            for obj in self.objfiles:
+                for u in obj.units:
+                    for d in u.deps:
+                        if d.objfile == None or d.objfile is obj: continue
+                        users.setdefault(d.objfile, set()).add(obj)
+                    for d in linked_units(u):
+                        if d.objfile is obj: continue
+                        linkers.setdefault(d.objfile, set()).add(obj)
+                    for inc in u.includes:
+                        # included files which were found have been scanned
+                        key = inc if inc in self.resolver.closures \
+                            else (None, path.basename(inc))
+                        includers.setdefault(key, set()).add(obj)
+            self._reverse = (users, linkers, includers)
+        return self._reverse
+
+    def impact(self, files, depth = None):
+        """
+        What is affected by changes in given files (sources or included
+        files): objects to be compiled again, each with the number of steps
+        from a changed file, and programs to be linked again. With depth,
+        only objects up to that many steps away are given.
+        """
+        users, linkers, includers = self.reverse_index()
+        names = set(path.normpath(f) for f in files)
+        changed = [ obj for obj in self.objfiles if obj.units and \
+            (path.normpath(obj.filepath or obj.fnsrc) in names or obj.fnsrc in names) ]
+        for f in names:
+            changed.extend(includers.get(f, ()))
+            changed.extend(includers.get((None, path.basename(f)), ()))
+
+        affected = dict()
+        queue = list()
+        for obj in changed:
+            if obj in affected: continue
+            affected[obj] = 0
+            queue.append(obj)
+        for obj in queue:
+            if depth != None and affected[obj] >= depth: continue
+            for user in users.get(obj, ()):
+                if user in affected: continue
+                affected[user] = affected[obj] + 1
+                queue.append(user)
+
+        linked = set(affected)
+        queue = list(affected)
+        for obj in queue:
+            for user in linkers.get(obj, ()):
+                if user in linked: continue
+                linked.add(user)
+                queue.append(user)
+
+        return dict(
+            objects = dict((obj.fnobj, n) for obj, n in affected.items()),
+            programs = sorted(p.objfile.fnexe for p in self.programs() if p.objfile in linked),
+        )
+
+    def schedule(self, timings = None):
+        """
+        Analyze the order of compilation. Objects are grouped in waves: an
+        object is in wave n if the longest chain of objects it must wait for
+        has length n. With compile times (dictionary: object -> seconds;
+        1 for unknown objects, or the median of known times), also computes
+        the critical path and, for every object, the priority: the time from
+        its start to the end of the build if nothing else limited it.
+        Objects depending on each other in a cycle are treated as one.
+        """
+        objects = self.object_dependencies(includes = False)
+        names = sorted(objects)
+        index = dict((n, i) for i, n in enumerate(names))
+        edges = [ [ index[d] for d in sorted(objects[n]) if d in index ] for n in names ]
+        # prerequisites come before the objects depending on them
+        components = strongly_connected(edges)
+        component_of = [0] * len(names)
+        for c, members in enumerate(components):
+            for v in members: component_of[v] = c
+
+        known = sorted(timings.values()) if timings else []
+        default = known[len(known) // 2] if known else 1.0
+        times = dict((n, timings.get(n, default) if timings else 1.0) for n in names)
+
+        prereqs = [ sorted(set(component_of[w] for v in members for w in edges[v]) - set((c,))) \
+            for c, members in enumerate(components) ]
+        weight = [ sum(times[names[v]] for v in members) for members in components ]
+        level = [0] * len(components)
+        finish = [0.0] * len(components)
+        before = [None] * len(components)
+        for c in range(len(components)):
+            for p in prereqs[c]:
+                level[c] = max(level[c], level[p] + 1)
+                if before[c] == None or finish[p] > finish[before[c]]: before[c] = p
+            finish[c] = weight[c] + (finish[before[c]] if before[c] != None else 0.0)
+        priority = list(weight)
+        for c in range(len(components) - 1, -1, -1):
+            for p in prereqs[c]:
+                priority[p] = max(priority[p], weight[p] + priority[c])
+
+        waves = [ list() for i in range(max(level) + 1 if level else 0) ]
+        for c, members in enumerate(components):
+            waves[level[c]].extend(names[v] for v in members)
+        path = list()
+        c = max(range(len(components)), key = lambda c: finish[c]) if components else None
+        while c != None:
+            path.extend(sorted(names[v] for v in components[c]))
+            c = before[c]
+        path.reverse()
+
+        return dict(
+            waves = [ sorted(w) for w in waves ],
+            critical_path = path,
+            critical_time = max(finish) if finish else 0.0,
+            total_time = sum(weight),
+            times = times,
+            priority = dict((names[v], priority[c]) \
+                for c, members in enumerate(components) for v in members),
+            cycles = [ sorted(names[v] for v in members) \
+                for members in components if len(members) > 1 ],
+        )
 
     #--------------------------------------------------------------------------#
 
-    # scanning files complete, now analyze filenames and parse each foratran source
-    for reldir, filelist in inp:
-        for fn in filelist:
-            if re.search(re_fortext, fn) == None: continue
+    def emit(self, output, format = 'make', **options):
+        """write the graph to output using one of the emitters"""
+        if format not in emitters:
+            raise ValueError('unknown format {}'.format(format))
+        emitters[format](self, output, **options)
 
-            # relative directory + filename
-            filepath = path.join(reldir,fn)
+#------------------------------------------------------------------------------#
 
-            with open(filepath, 'r', encoding = args.encoding) as f:
-                obj = SourceFile(fn)
-                objfiles.add(obj)
-                parse_source(f, obj)
+# emitters write the graph in some format: emitters[name](graph, output, **options)
+emitters = dict()
 
-    #--------------------------------------------------------------------------#
+def emitter(name):
+    """decorator registering an emitter"""
+    def register(f):
+        emitters[name] = f
+        return f
+    return register
+
+#------------------------------------------------------------------------------#
 
-    allprograms = set(filter(lambda x: type(x) == Program and x.objfile != None, universe))
+class FoldWriter(object):
+    """
+    Buffered writer of makefile text. Lines given as words (or as text) are
+    folded at word boundaries, so that they are not longer than width, with
+    continuation lines ending with a backslash and indented by four spaces.
+    Words are written as they come, in linear time, and the buffer goes to
+    the output in large pieces, so huge rules take no extra memory. With
+    width 0, lines are not folded.
+
+        out = FoldWriter(stdout, 80)
+        out.rule(['prog'], objects)
+        out.flush()
+    """
+    re_token = LazyRegex(r'(\S*)(\s)')
+    re_other_space = LazyRegex(r'[^\S ]')
+
+    def __init__(self, output, width = 80, cont = '\\', indent = '    ', bufsize = 1 << 16):
+        self.output = output
+        self.width = width
+        self.cont = cont
+        self.indent = indent
+        self.bufsize = bufsize
+        self.buffer = list()
+        self.size = 0
+
+    def write(self, text):
+        """write text as it is"""
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.bufsize: self.flush()
+
+    def flush(self):
+        self.output.write(''.join(self.buffer))
+        self.buffer = list()
+        self.size = 0
+
+    def _fold(self, tokens):
+        # tokens are (word, following whitespace); a line is continued when
+        # the word would not fit together with the backslash
+        limit, cont, indent = self.width - len(self.cont), self.cont, self.indent
+        parts = list()
+        append = parts.append
+        n = 0
+        for word, space in tokens:
+            if self.width and n + len(word) >= limit:
+                append(' ' * (limit - n) + cont + '\n' + indent)
+                n = len(indent)
+            append(word)
+            append(space)
+            n += len(word) + len(space)
+            if len(parts) >= 4096:
+                self.write(''.join(parts))
+                del parts[:]
+        append('\n')
+        self.write(''.join(parts))
+
+    def line(self, text):
+        """
+        Write a line, keeping all its whitespace; it is followed by a space,
+        as with fold() of fortdep.
+        """
+        if self.re_other_space.search(text):
+            self._fold(m.groups() for m in self.re_token.finditer(text + ' '))
+        else:
+            self._fold((w, ' ') for w in text.split(' '))
+
+    def words(self, words):
+        """write a line of words separated by spaces"""
+        def tokens():
+            last = None
+            for w in words:
+                if last != None: yield last, ' '
+                last = w
+            if last != None: yield last, ''
+        self._fold(tokens())
+
+    def rule(self, targets, prerequisites):
+        """write a rule: targets: prerequisites"""
+        from itertools import chain
+        targets = list(targets)
+        self.words(chain(targets[:-1], [ targets[-1] + ':' ], prerequisites))
+
+#------------------------------------------------------------------------------#
+
+def write_if_changed(filename, text):
+    """
+    Write text to the file unless it already has this content, so that its
+    mtime does not change. Returns True if the file was written.
+    """
+    from os import replace, remove
+    try:
+        with open(filename, 'r', encoding = 'utf-8', newline = '') as f:
+            if f.read() == text: return False
+    except (OSError, ValueError):
+        pass
+    # readers (make -j) see either the old or the new file, never a part
+    tmp = '{}.{}.tmp'.format(filename, getpid())
+    try:
+        with open(tmp, 'w', encoding = 'utf-8', newline = '') as f:
+            f.write(text)
+        replace(tmp, filename)
+    except BaseException:
+        if path.exists(tmp): remove(tmp)
+        raise
+    return True
+
+def warn_problems(graph):
+    """warn about circular uses of modules and modules not found in any file"""
+    for cycle in graph.cycles():
+        graph.warn('circular use of modules: {}'.format(
+            ', '.join(u.name for u in cycle)))
+    for m in sorted(graph.missing(), key = lambda m: m.name):
+        graph.warn('module {} was not found in any file'.format(m))
+
+def interface_rule(files, fnobj):
+    """rule remaking module files which are missing"""
+    return '{}: {}\n\t@test -f $@ || {{ $(RM) $<; $(MAKE) $<; }}\n' \
+        .format(' '.join(files), fnobj)
+
+def object_rules(graph, obj, includes = True, interfaces = False,
+        moddir = None, programs = False):
+    """makefile rules for the object of one source file"""
+    deps = set()
+    for u in obj.units: deps |= graph.prerequisites(u, includes, interfaces, moddir)
+    rules = [ '# generated by fortdep from {}\n'.format(obj.fnsrc) ]
+    if deps: rules.append('{}: {}\n'.format(obj.fnobj, ' '.join(sorted(deps))))
+    if interfaces:
+        for u in obj.units:
+            files = interface_files(u, moddir)
+            if files: rules.append(interface_rule(files, obj.fnobj))
+    if programs:
+        for u in obj.units:
+            if not isinstance(u, Program): continue
+            rules.append('{}: {}\n'.format(obj.fnexe,
+                ' '.join(sorted(graph.link_objects(u)))))
+    return ''.join(rules)
+
+def write_fragments(graph, directory, rules):
+    """
+    Write rules(obj) of each source file with units to directory/obj.d,
+    leaving files with unchanged rules alone, and remove fragments of
+    sources which are gone. Returns the list of fragments.
+    """
+    from os import makedirs, remove
+    makedirs(directory, exist_ok = True)
+    written = list()
+    fragments = list()
+    for obj in sorted(graph.objfiles, key = lambda obj: obj.fnobj):
+        if not obj.units: continue
+        fn = path.join(directory, path.splitext(obj.fnobj)[0] + '.d')
+        if write_if_changed(fn, rules(obj)): written.append(fn)
+        fragments.append(fn)
+    keep = set(fragments)
+    for entry in scandir(directory):
+        if not entry.name.endswith('.d') or entry.path in keep: continue
+        with open(entry.path, 'r', encoding = 'utf-8', errors = 'replace') as f:
+            if not f.readline().startswith('# generated by fortdep'): continue
+        remove(entry.path)
+        written.append(entry.path)
+    if graph.verbose and graph.log:
+        graph.log.write('{} of {} fragments updated\n'.format(len(written), len(fragments)))
+    return fragments
+
+def expand_rules(rules):
+    """set of (target, prerequisite) pairs of rules given as (targets, prerequisites)"""
+    return set((t, p) for targets, prereqs in rules for t in targets for p in prereqs)
+
+def compress_rules(rules, nested = True):
+    """
+    Shorten makefile rules given as (targets, prerequisites), keeping every
+    target depending on exactly the same prerequisites. Targets with equal
+    sets of prerequisites share one rule. With nested, a set contained in
+    other sets is written once with all their targets, and removed from the
+    rules of these targets, whenever that takes fewer words. Sets are found
+    by hashing and through an index of rules by prerequisite, so the time
+    is about linear in the size of the rules. Returns a sorted list of
+    (targets, prerequisites) pairs of sets.
+    """
+    rules = list(rules)
+    deps = dict()
+    for targets, prereqs in rules:
+        for t in targets: deps.setdefault(t, set()).update(prereqs)
+    groups = dict()
+    for t, prereqs in deps.items():
+        if prereqs: groups.setdefault(frozenset(prereqs), set()).add(t)
+    # larger sets first: when a set is factored out of others, the larger
+    # sets inside them have been factored out already
+    keys = sorted(groups, key = lambda k: (-len(k), sorted(k)))
+    targets = [ groups[k] for k in keys ]
+    prereqs = [ set(k) for k in keys ]
+
+    if nested:
+        index = dict()
+        for i, k in enumerate(keys):
+            for p in k: index.setdefault(p, list()).append(i)
+        for i, k in enumerate(keys):
+            rarest = min((index[p] for p in k), key = len)
+            for j in rarest:
+                if len(keys[j]) <= len(k) or not prereqs[j] >= k: continue
+                # words saved in rule j against words added to rule i; if
+                # nothing would be left of rule j, it goes away entirely
+                if len(k) <= len(targets[j]) and prereqs[j] != k: continue
+                targets[i] |= targets[j]
+                prereqs[j] -= k
+
+    compressed = sorted(((t, p) for t, p in zip(targets, prereqs) if p),
+        key = lambda r: sorted(r[0]))
+    if expand_rules(compressed) != expand_rules(rules):
+        raise Exception('compressing rules changed the dependencies')
+    return compressed
+
+#------------------------------------------------------------------------------#
+
+@emitter('make')
+def emit_makefile(graph, output, programs = False, includes = True,
+        scaffold = False, vpath = None, interfaces = False, moddir = None,
+        fragments = None, optimize = 0, width = 0, archives = False, **options):
+    """
+    Makefile rules: objects depending on objects (and included files) and,
+    optionally, programs depending on all objects they are linked with.
+    With scaffold, a complete makefile is generated.
+
+    With interfaces, objects depend on module files of the modules they use
+    and module files depend on objects which produce them. Compilers that do
+    not rewrite a module file when the interface did not change (gfortran)
+    then keep make from recompiling the users of a module when only its
+    implementation (or its submodule) has changed.
+
+    With fragments (a directory), rules of each source are written to a
+    file of their own there and the output only includes these files.
+    Fragments are rewritten only if their content changes.
+
+    With optimize, rules are shortened by compress_rules: objects (and
+    programs) with the same prerequisites share one rule and, from level 2,
+    common prerequisites are written once.
+
+    With width, lines longer than that are folded.
+
+    With archives, objects of each directory (except objects of programs)
+    go to a static library, updated with the objects which changed, and
+    programs are linked with the libraries they need (see link_archives).
+    """
+    allprograms = graph.programs()
+    output = FoldWriter(output, width)
+    warn_problems(graph)
 
     #--------------------------------------------------------------------------#
 
-    if args.whole:
+    if scaffold:
         output.write('# generated by fortdep\n\n')
-        output.write('prefix := /usr/local\nFC := f95\nFFLAGS := -O2\nLDLIBS :=\n\n')
-        output.write('programs := ' + ' '.join(sorted([x.objfile.fnexe for x in allprograms])) + '\n')
-        if make_vpath:
-            output.write('VPATH := {}\n'.format(':'.join(make_vpath)))
+        libraries = set()
+        for p in allprograms: libraries |= graph.libraries(p)
+        output.write('prefix := /usr/local\nFC := f95\nFFLAGS := -O2\nLDLIBS :={}\n{}\n' \
+            .format(''.join(' ' + l for l in sorted(libraries)),
+                'ARFLAGS := rcs\n' if archives else ''))
+        output.words(['programs', ':='] + sorted([x.objfile.fnexe for x in allprograms]))
+        if vpath:
+            output.write('VPATH := {}\n'.format(':'.join(vpath)))
         output.write('\nall: $(programs)\n\n')
 
     #--------------------------------------------------------------------------#
     # model is complete, now we can generate the products
 
-    for u in sorted(universe, key = lambda u: u.objfile.fnobj if u.objfile else ''):
-        if u.objfile == None:
-            stderr.write('warning: module {} was not found in any file\n'.format(u))
-            continue
-        deps_fixed = set(x.objfile.fnobj for x in u.deps if x.objfile != None)
-        if (not args.no_includes) or args.whole:
-            deps_fixed |= u.includes
-        deps_fixed -= set((u.objfile.fnobj,))
-        if len(deps_fixed) == 0: continue
-        output.write('{}: {}\n'.format(u.objfile.fnobj, ' '.join(sorted(deps_fixed))))
-
-    #--------------------------------------------------------------------------#
-
-    if args.whole or args.programs:
+    if fragments != None:
+        # rules of each source go to a file of its own, included from output
+        for fn in write_fragments(graph, fragments, lambda obj: object_rules(graph,
+                obj, includes or scaffold, interfaces, moddir, scaffold or programs)):
+            output.write('include {}\n'.format(fn))
+    else:
+        if optimize:
+            objects = graph.object_dependencies(includes or scaffold, interfaces, moddir)
+            rules = [ ((obj,), deps) for obj, deps in objects.items() ]
+            for targets, deps in compress_rules(rules, optimize > 1):
+                output.rule(sorted(targets), sorted(deps))
+        else:
+            for u in sorted(graph.universe, key = lambda u: u.objfile.fnobj if u.objfile else ''):
+                if u.objfile == None: continue
+                deps_fixed = graph.prerequisites(u, includes or scaffold, interfaces, moddir)
+                if len(deps_fixed) == 0: continue
+                output.rule([u.objfile.fnobj], sorted(deps_fixed))
+
+        if interfaces:
+            # if the module file is missing, the object has to be compiled again
+            output.write('\n')
+            for u in sorted(graph.universe, key = lambda u: u.objfile.fnobj if u.objfile else ''):
+                files = interface_files(u, moddir) if u.objfile else None
+                if not files: continue
+                output.write(interface_rule(files, u.objfile.fnobj))
+
+        if (scaffold or programs) and not archives:
+            output.write('\n')
+            if optimize:
+                links = [ ((p.objfile.fnexe,), graph.link_objects(p)) for p in allprograms ]
+                for targets, deps in compress_rules(links, optimize > 1):
+                    output.rule(sorted(targets), sorted(deps))
+            else:
+                for p in sorted(allprograms, key = lambda u: u.objfile.fnobj):
+                    d = graph.link_objects(p)
+                    output.rule([p.objfile.fnexe], sorted(d))
+
+    if archives and (scaffold or programs):
+        # libraries come in the order the linker needs them
+        members = graph.archives()
+        output.write('\n')
+        output.words(['archives', ':='] + sorted(members))
+        for a in sorted(members):
+            output.rule([a], sorted(members[a]))
         output.write('\n')
         for p in sorted(allprograms, key = lambda u: u.objfile.fnobj):
-            d = set(x.objfile.fnobj for x in walktree(p) if x.objfile != None)
-            output.write('{}: {}\n'.format(p.objfile.fnexe, ' '.join(sorted(d))))
+            output.rule([p.objfile.fnexe], graph.link_archives(p))
 
     #--------------------------------------------------------------------------#
 
-    if args.whole:
+    if scaffold:
         output.write('\n')
         output.write('%.o: %.f90\n\t$(FC) $(INCLUDE) $(FFLAGS) -c $< -o $@\n')
         output.write('%.o: %.F90\n\t$(FC) $(INCLUDE) $(CPPFLAGS) $(FFLAGS) -c $< -o $@\n')
+        if archives:
+            # only the objects which changed are replaced in the archive
+            output.write('$(archives):\n\t$(AR) $(ARFLAGS) $@ $?\n')
         output.write('$(programs):\n\t$(FC) $(INCLUDE) $(FFLAGS) $(LDFLAGS) $^ $(LDLIBS) -o $@\n')
         output.write('\ninstall:\n\tinstall -d $(prefix)/bin\n'
             '\tinstall $(programs) $(prefix)/bin\n\n')
-        output.write('clean:\n\t$(RM) *.o *.mod *.smod $(programs)\n\n')
+        output.write('clean:\n\t$(RM) *.o *.mod *.smod $(programs){}\n\n'.format(
+            ' $(archives)' if archives else ''))
         output.write('.PHONY: all install clean\n')
 
+    output.flush()
+
+#------------------------------------------------------------------------------#
+
+@emitter('json')
+def emit_json(graph, output, includes = True, **options):
+    """
+    The whole graph as a JSON document: modules with the files providing
+    them, objects with their prerequisites, and programs with link sets.
+    """
+    import json
+    data = dict(
+        modules = dict((m.name, m.objfile.fnsrc) for m in \
+            graph.universe.modules.values() if m.objfile != None),
+        submodules = dict((m.name, sorted(s.name for s in m.submodules)) \
+            for m in graph.universe.modules.values() if m.submodules),
+        missing = sorted(m.name for m in graph.missing()),
+        objects = dict((obj, sorted(deps)) for obj, deps \
+            in sorted(graph.object_dependencies(includes).items())),
+        external = dict((name, library) for name, (library, manifest) \
+            in graph.external.items()),
+        programs = dict((p.name, dict(executable = p.objfile.fnexe,
+            object = p.objfile.fnobj, link = sorted(graph.link_objects(p)),
+            libraries = sorted(graph.libraries(p)))) for p in graph.programs()),
+    )
+    json.dump(data, output, indent = 1, sort_keys = True)
+    output.write('\n')
+
+@emitter('manifest')
+def emit_manifest(graph, output, library = None, **options):
+    """
+    Manifest of a library, for projects using its modules without its
+    sources: modules with objects providing them, submodules of modules
+    and the library (file or -lname) to link with.
+    """
+    import json
+    data = dict(
+        fortdep_manifest = 1,
+        library = library,
+        modules = dict((m.name, m.objfile.fnobj) for m in \
+            graph.universe.modules.values() if m.objfile != None),
+        submodules = dict((m.name, sorted(s.name for s in m.submodules)) \
+            for m in graph.universe.modules.values() if m.submodules and m.objfile != None),
+    )
+    json.dump(data, output, indent = 1, sort_keys = True)
+    output.write('\n')
+
+@emitter('fragment')
+def emit_fragment(graph, output, **options):
+    """
+    Fragment of a graph, to be merged with others (fortdep2 merge): what
+    was found in each file, in order, with modules provided by the files
+    and modules they use but do not provide. Sources of a large tree can
+    be scanned in parts (shards) by many workers this way.
+    """
+    import json
+    data = dict(
+        fortdep_fragment = 1,
+        format = cache_format,
+        encoding = graph.encoding,
+        files = [ [obj.filepath or obj.fnsrc, obj.records or []] for obj in graph.objfiles ],
+        modules = dict((m.name, m.objfile.filepath or m.objfile.fnsrc) for m in \
+            graph.universe.modules.values() if m.objfile != None),
+        unresolved = sorted(m.name for m in graph.missing()),
+    )
+    # written compactly, as the cache: fragments of large trees are large
+    json.dump(data, output, sort_keys = True, separators = (',', ':'))
+    output.write('\n')
+
+#------------------------------------------------------------------------------#
+
+def load_timings(filename):
+    """
+    Read compile times of objects: either JSON {"object": seconds, ...} or
+    text with "object seconds" on each line.
+    """
+    import json
+    with open(filename, 'r', encoding = 'utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('{'):
+        return dict((k, float(v)) for k, v in json.loads(text).items())
+    timings = dict()
+    for line in text.split('\n'):
+        line = line.split('#', 1)[0].split()
+        if len(line) == 0: continue
+        if len(line) != 2: raise ValueError('{}: wrong line: {}'.format(filename, ' '.join(line)))
+        timings[line[0]] = float(line[1])
+    return timings
+
+@emitter('waves')
+def emit_waves(graph, output, timings = None, **options):
+    """
+    Report on the order of compilation: waves of objects which can be
+    compiled in parallel, the critical path and objects ordered by priority.
+    """
+    s = graph.schedule(timings)
+    output.write('# waves: objects which can be compiled at the same time\n')
+    for i, wave in enumerate(s['waves']):
+        output.write('wave {} ({}): {}\n'.format(i, len(wave), ' '.join(wave)))
+    output.write('\n# critical path: {} objects, {:.2f} s of {:.2f} s total '
+        '(parallel speedup at most {:.1f})\n'.format(len(s['critical_path']),
+        s['critical_time'], s['total_time'],
+        s['total_time'] / s['critical_time'] if s['critical_time'] > 0 else 1.0))
+    for obj in s['critical_path']:
+        output.write('{} {:.2f}\n'.format(obj, s['times'][obj]))
+    output.write('\n# priority: time from the start of compiling the object '
+        'to the end of the build\n')
+    for obj in sorted(s['priority'], key = lambda o: (-s['priority'][o], o)):
+        output.write('{} {:.2f}\n'.format(obj, s['priority'][obj]))
+    for cycle in s['cycles']:
+        graph.warn('objects depend on each other: {}'.format(' '.join(cycle)))
+
+#------------------------------------------------------------------------------#
+
+def _ninja_escape(p):
+    return p.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def _ninja_paths(paths):
+    return ' '.join(_ninja_escape(p) for p in sorted(paths))
+
+# variables of the ninja file and their defaults, which are taken from the
+# environment of fortdep
+ninja_variables = [ ('fc', 'FC', 'f95'), ('fflags', 'FFLAGS', '-O2'),
+    ('cppflags', 'CPPFLAGS', ''), ('ldflags', 'LDFLAGS', ''), ('ldlibs', 'LDLIBS', '') ]
+
+@emitter('ninja')
+def emit_ninja(graph, output, includes = True, moddir = None,
+        manifest = None, command = None, **options):
+    """
+    Ninja build file: an edge compiling each source, with the module files
+    it writes as implicit outputs and the module files it reads (and files
+    it includes) as implicit inputs, and an edge linking each program. The
+    compile rule has restat, so when the compiler leaves a module file
+    untouched, the objects using the module are not compiled again. With
+    manifest (the name of the file written) and command (the command line
+    of fortdep), the file regenerates itself when the sources change.
+    Module files are expected in moddir (-J for gfortran, in fflags).
+    The compiler and flags are taken from the environment (FC, FFLAGS...).
+    """
+    allprograms = graph.programs()
+    warn_problems(graph)
+
+    output.write('# generated by fortdep\n\n')
+    # implicit outputs
+    output.write('ninja_required_version = 1.7\n\n')
+    for name, env, default in ninja_variables:
+        output.write('{} = {}\n'.format(name, environ.get(env, default)).replace(' \n', '\n'))
+    output.write('\n')
+    output.write('rule fc\n  command = $fc $fflags -c $in -o $out\n'
+        '  description = FC $out\n  restat = 1\n\n')
+    output.write('rule fcpp\n  command = $fc $cppflags $fflags -c $in -o $out\n'
+        '  description = FC $out\n  restat = 1\n\n')
+    output.write('rule link\n  command = $fc $fflags $ldflags $in $ldlibs -o $out\n'
+        '  description = LINK $out\n\n')
+
+    #--------------------------------------------------------------------------#
+
+    sources = list()
+    for obj in sorted(graph.objfiles, key = lambda obj: obj.fnobj):
+        if not obj.units: continue
+        fnsrc = path.normpath(obj.filepath or obj.fnsrc)
+        sources.append(fnsrc)
+        outputs = set()
+        inputs = set()
+        for u in obj.units:
+            outputs.update(interface_files(u, moddir) or ())
+            inputs |= graph.prerequisites(u, False, True, moddir)
+            if not includes: continue
+            # included files were found when the graph was built
+            for inc in u.includes:
+                if path.isfile(inc): inputs.add(path.normpath(inc))
+                else: graph.warn('file {} included from {} was not found'.format(inc, obj.fnsrc))
+        output.write('build {}{}: {} {}{}\n'.format(_ninja_escape(obj.fnobj),
+            ' | ' + _ninja_paths(outputs) if outputs else '',
+            'fcpp' if re_preprocessed.search(fnsrc) else 'fc', _ninja_escape(fnsrc),
+            ' | ' + _ninja_paths(inputs) if inputs else ''))
+
+    #--------------------------------------------------------------------------#
+
+    output.write('\n')
+    for p in sorted(allprograms, key = lambda u: u.objfile.fnobj):
+        output.write('build {}: link {}\n'.format(_ninja_escape(p.objfile.fnexe),
+            _ninja_paths(graph.link_objects(p))))
+    targets = [ p.objfile.fnexe for p in allprograms ] if allprograms \
+        else [ obj.fnobj for obj in graph.objfiles if obj.units ]
+    # ninja does not accept default without targets
+    if targets: output.write('\ndefault {}\n'.format(_ninja_paths(targets)))
+
+    #--------------------------------------------------------------------------#
+
+    if manifest and command:
+        # directories are not inputs, since objects may be written there;
+        # new sources are found when any of the known ones changes
+        output.write('\nrule fortdep\n  command = {}\n  description = FORTDEP $out\n'
+            '  generator = 1\n  restat = 1\n\n'.format(command.replace('$', '$$')))
+        output.write('build {}: fortdep | {}\n'.format(_ninja_escape(manifest),
+            _ninja_paths(sources)))
+
+#------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x002, 0x004, 0x008
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x040, 0x080, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_IGNORED, IN_ISDIR = 0x400, 0x800, 0x8000, 0x40000000
+
+# usual names of included files
+re_includext = LazyRegex(r'\.(inc|h|fi|fh)$', re.IGNORECASE)
+
+def _is_relevant(name):
+    """changes in which files can affect the dependencies"""
+    return bool(re_fortext.search(name) or re_includext.search(name)) \
+        or name == '.fortdepignore' or name in ('GNUmakefile', 'makefile', 'Makefile')
+
+class InotifyWatcher(object):
+    """
+    Waits for changes in directories using Linux inotify, through ctypes.
+    Changes of paths for which ignore(path) is true are not reported.
+    """
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+        | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ATTRIB
+
+    def __init__(self, ignore = None):
+        import ctypes, ctypes.util
+        self.ignore = ignore or (lambda fn: False)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        self.fd = self.libc.inotify_init1(0o2000000) # IN_CLOEXEC
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = dict()
+
+    def watch(self, dirs):
+        from os import fsencode
+        dirs = set(dirs)
+        for d in set(self.watches) - dirs:
+            self.libc.inotify_rm_watch(self.fd, self.watches.pop(d))
+        for d in dirs - set(self.watches):
+            wd = self.libc.inotify_add_watch(self.fd, fsencode(d), self.mask)
+            if wd >= 0: self.watches[d] = wd
+
+    def _read(self, timeout):
+        """wait for events; return True if any of them is relevant"""
+        from select import select
+        from struct import unpack_from
+        from os import read
+        if not select([self.fd], [], [], timeout)[0]: return None
+        buf = read(self.fd, 65536)
+        dirs = dict((w, d) for d, w in self.watches.items())
+        relevant = False
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = unpack_from('iIII', buf, i)
+            name = buf[i + 16 : i + 16 + length].rstrip(b'\0').decode(errors = 'replace')
+            i += 16 + length
+            if mask & IN_IGNORED:
+                # watched directory is gone
+                for d, w in list(self.watches.items()):
+                    if w == wd: del self.watches[d]
+                relevant = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                relevant = True
+            elif (mask & IN_ISDIR or _is_relevant(name)) \
+                    and not self.ignore(path.join(dirs.get(wd, ''), name)):
+                relevant = True
+        return relevant
+
+    def wait(self, debounce):
+        while not self._read(None): pass
+        # wait until changes stop coming
+        while self._read(debounce) != None: pass
+
+class PollingWatcher(object):
+    """
+    Waits for changes by comparing the subdirectories and modification times
+    of relevant files in the directories, every given interval. Paths for
+    which ignore(path) is true are left out.
+    """
+    def __init__(self, interval = 1.0, ignore = None):
+        self.interval = interval
+        self.ignore = ignore or (lambda fn: False)
+        self.dirs = list()
+
+    def watch(self, dirs):
+        self.dirs = sorted(set(dirs))
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = dict()
+        for d in self.dirs:
+            try:
+                snapshot[d] = True
+                with scandir(d) as it:
+                    for e in it:
+                        if self.ignore(e.path): continue
+                        if e.is_dir():
+                            snapshot[e.path] = True
+                        elif _is_relevant(e.name):
+                            st = e.stat()
+                            snapshot[e.path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                snapshot[d] = None
+        return snapshot
+
+    def wait(self, debounce):
+        from time import sleep
+        while True:
+            sleep(self.interval)
+            current = self._snapshot()
+            if current != self.snapshot: break
+        # wait until changes stop coming
+        while True:
+            sleep(debounce)
+            self.snapshot, previous = self._snapshot(), current
+            if self.snapshot == previous: return
+            current = self.snapshot
+
+def make_watcher(interval = 1.0, ignore = None):
+    try:
+        return InotifyWatcher(ignore)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(interval, ignore)
+
+#------------------------------------------------------------------------------#
+
+def watch(args, cache, update):
+    """
+    Wait for changes in the sources, scan the files which have changed and
+    call update(graph, make_vpath) with the new graph.
+    """
+    # files written by this program, such as -o deps.inc, are not changes
+    output = path.abspath(args.output) if args.output != '--' else None
+    fragments = path.abspath(args.fragments) if args.fragments else None
+    def ignore(fn):
+        fn = path.abspath(fn)
+        return output != None and (fn == output \
+                or fn.startswith(output + '.') and fn.endswith('.tmp')) \
+            or fragments != None and (fn == fragments \
+                or fn.startswith(fragments + path.sep))
+    watcher = make_watcher(ignore = ignore)
+    if args.verbose: stderr.write('watching using {}\n'.format(type(watcher).__name__))
+    while True:
+        inp, make_vpath = discover(args, cache)
+        # watch before scanning, so that no change is missed
+        watcher.watch([ reldir for reldir, filelist in inp ] + ['.'] + args.include_path)
+        try:
+            graph = build_graph(args, inp, cache)
+            update(graph, make_vpath)
+        except Exception as e:
+            stderr.write('error: {}\n'.format(e))
+        watcher.wait(args.debounce)
+
+#------------------------------------------------------------------------------#
+
+def watch_output(args, cache):
+    """
+    Keep the output file up to date, rewriting it only if it changes.
+    """
+    from io import StringIO
+    def update(graph, make_vpath):
+        buf = StringIO()
+        emit(graph, buf, args, make_vpath)
+        if write_if_changed(args.output, buf.getvalue()):
+            stderr.write('{} updated\n'.format(args.output))
+    watch(args, cache, update)
+
+#------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
+
+def dependency_index(graph):
+    """
+    Answers to all queries served by the daemon: provider of each module,
+    dependencies of each object (and the reverse) and link sets of programs.
+    """
+    programs = dict()
+    for p in graph.programs():
+        programs[p.name] = programs[p.objfile.fnexe] = sorted(graph.link_objects(p))
+    return dict(
+        module = dict((m.name, m.objfile.fnobj) for m in \
+            graph.universe.modules.values() if m.objfile != None),
+        deps = dict((k, sorted(v)) for k, v in graph.object_dependencies().items()),
+        rdeps = dict((k, sorted(v)) for k, v in graph.dependents().items()),
+        link = programs,
+    )
+
+def answer_query(index, request):
+    """answer a query: {"query": "module", "name": "m1"}"""
+    if not isinstance(request, dict): return dict(error = 'invalid request')
+    query, name = request.get('query'), request.get('name')
+    if query == 'ping': return dict(result = __version__)
+    if not isinstance(query, str) or query not in index:
+        return dict(error = 'unknown query {}'.format(query))
+    if not isinstance(name, str): return dict(error = 'missing name')
+    key = name.lower() if query in ('module', 'link') else name
+    if key not in index[query] and query == 'link':
+        key = name
+    if key not in index[query]:
+        if query == 'rdeps' and name in index['deps']: return dict(result = [])
+        return dict(error = '{} not found'.format(name))
+    return dict(result = index[query][key])
+
+def serve(args, cache):
+    """
+    Serve queries about the dependencies over a Unix socket, keeping the
+    answers up to date as sources change. The protocol is one JSON object
+    per line, both ways.
+    """
+    import json, socket, threading
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+    from os import remove
+
+    state = dict()
+    ready = threading.Event()
+    def update(graph, make_vpath):
+        state['index'] = dependency_index(graph)
+        ready.set()
+        if args.verbose: stderr.write('index updated\n')
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    response = answer_query(state['index'], json.loads(line))
+                except Exception as e:
+                    response = dict(error = str(e))
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+    class Server(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+    # remove a stale socket, but never steal it from a running server
+    if path.exists(args.socket):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(args.socket)
+            stderr.write('error: server already running at {}\n'.format(args.socket))
+            exit(1)
+        except ConnectionRefusedError:
+            remove(args.socket)
+        finally:
+            probe.close()
+
+    thread = threading.Thread(target = watch, args = (args, cache, update))
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+
+    # clean up the socket also when terminated
+    from signal import signal, SIGTERM
+    signal(SIGTERM, lambda signum, frame: exit(0))
+
+    server = Server(args.socket, Handler)
+    stderr.write('serving at {}\n'.format(args.socket))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        remove(args.socket)
+
+#------------------------------------------------------------------------------#
+
+def query_main(argv):
+    """
+    Client for the daemon: fortdep2 query module m1
+    """
+    import json, socket
+    parser = argument_parser('fortdep2 query')
+    parser.add_argument('--socket', default = '.fortdep.sock',
+            help = 'socket of the server (default: .fortdep.sock)')
+    parser.add_argument('query', choices = ['module', 'deps', 'rdeps', 'link', 'ping'],
+            help = 'object providing a module, dependencies of an object, '
+            'objects depending on it, or objects linked into a program')
+    parser.add_argument('name', nargs = '*')
+    args = parser.parse_args(argv)
+    if args.query == 'ping':
+        requests = [ dict(query = 'ping') ]
+    elif args.name:
+        requests = [ dict(query = args.query, name = name) for name in args.name ]
+    else:
+        parser.error('query {} requires a name'.format(args.query))
+
+    status = 0
+    client = socket.socket(socket.AF_UNIX)
+    try:
+        client.connect(args.socket)
+    except OSError as e:
+        stderr.write('error: cannot connect to {}: {}\n'.format(args.socket, e))
+        return 2
+    with client, client.makefile('rwb') as f:
+        for request in requests:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            response = json.loads(f.readline())
+            if 'error' in response:
+                stderr.write('error: {}\n'.format(response['error']))
+                status = 1
+                continue
+            result = response['result']
+            stdout.write((' '.join(result) if isinstance(result, list) else result) + '\n')
+    return status
+
+#------------------------------------------------------------------------------#
+
+def impact_main(args):
+    """
+    Objects and programs affected by changed files: fortdep2 impact m1.f90
+    """
+    cache = None if args.no_cache else ParseCache(args.cache, cache_key(args))
+    inp, make_vpath = discover(args, cache)
+    graph = build_graph(args, inp, cache)
+    result = graph.impact(args.files, args.depth)
+    if args.json:
+        import json
+        json.dump(result, stdout, indent = 1, sort_keys = True)
+        stdout.write('\n')
+    else:
+        stdout.write('objects: {}\n'.format(' '.join(sorted(result['objects']))))
+        stdout.write('programs: {}\n'.format(' '.join(result['programs'])))
+    return 0
+
+#------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------#
+
+def argument_parser(prog):
+    """
+    ArgumentParser formatting the help to the width of the terminal, which
+    is found here: argparse would import shutil just for that.
+    """
+    from argparse import ArgumentParser, HelpFormatter
+    from os import get_terminal_size
+    width = environ.get('COLUMNS', '')
+    width = int(width) if width.isdigit() else 0
+    if width <= 0:
+        try:
+            width = get_terminal_size(stdout.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            width = 80
+    return ArgumentParser(prog, formatter_class = lambda prog: \
+        HelpFormatter(prog, width = (width or 80) - 2))
+
+def parse_cmdline_args(argv = None, command = None):
+    from sys import argv as sys_argv
+
+    # flags of the compiler start with -D or -I, which argparse would take
+    # for an option, so the value is joined to --cppflags
+    joined = list()
+    for a in (sys_argv[1:] if argv == None else argv):
+        if joined[-1:] == [ '--cppflags' ] and '--' not in joined:
+            joined[-1] += '=' + a
+        else:
+            joined.append(a)
+    argv = joined
+    parser = argument_parser('fortdep2' + (' ' + command if command else ''))
+    if command == 'serve':
+        parser.add_argument('--socket', default = '.fortdep.sock',
+            help = 'socket to listen at (default: .fortdep.sock)')
+    if command == 'impact':
+        parser.add_argument('--depth', type = int, metavar = 'N',
+            help = 'only objects at most N steps from the changed files')
+        parser.add_argument('--json', action = 'store_true',
+            help = 'print the result as JSON')
+        parser.add_argument('--path', '-d', action = 'append', default = [],
+            metavar = 'DIR', help = 'directory with sources; may be given many times')
+    parser.add_argument('--programs', '-p', action = 'store_true',
+            help = 'generate dependencies for programs')
+    parser.add_argument('--no-includes', '-i', action = 'store_true',
+            help = 'don\'t generate dependencies from includes')
+    parser.add_argument('--include-path', '-I', action = 'append', default = [],
+            metavar = 'DIR', help = 'search included files in DIR, after the directory '
+            'of the including file (as -I of the compiler); may be given many times')
+    parser.add_argument('--define', '-D', action = 'append', dest = 'macros', default = [],
+            type = lambda s: ('D', s), metavar = 'MACRO',
+            help = 'define MACRO (or MACRO=VALUE) for preprocessor conditionals '
+            'in .F* sources; only their active branches are scanned then')
+    parser.add_argument('--undefine', '-U', action = 'append', dest = 'macros', default = [],
+            type = lambda s: ('U', s), metavar = 'MACRO',
+            help = 'undefine MACRO for preprocessor conditionals')
+    parser.add_argument('--cppflags', type = str, metavar = 'FLAGS',
+            help = 'take -D and -U from FLAGS, as given to the compiler '
+            '(e.g. --cppflags "$(CPPFLAGS)"), before those given directly')
+    parser.add_argument('--scaffold', '-s', action = 'store_true', dest = 'whole',
+            help = 'generate entire makefile')
+    parser.add_argument('--interfaces', '-m', action = 'store_true',
+            help = 'make objects depend on module files (.mod, .smod) '
+            'instead of objects of used modules')
+    parser.add_argument('--moddir', type = str, metavar = 'DIR',
+            help = 'directory of module files (as given to the compiler)')
+    parser.add_argument('--optimize', '-O', type = int, choices = [0, 1, 2], default = 0,
+            help = 'shorten the rules: 1 merges rules with the same prerequisites, '
+            '2 also writes common prerequisites once')
+    parser.add_argument('--width', type = int, default = 0, metavar = 'N',
+            help = 'fold lines of makefiles longer than N characters (default: 0, '
+            'do not fold)')
+    parser.add_argument('--archives', '-a', action = 'store_true',
+            help = 'put objects of each directory to a static library and link '
+            'programs with the libraries they need (with --programs or --scaffold)')
+    parser.add_argument('--fragments', type = str, metavar = 'DIR',
+            help = 'write rules of each source to DIR/name.d and only include '
+            'them from the output')
+    parser.add_argument('--verbose', '-v', action = 'store_true',
+            help = 'more info')
+    parser.add_argument('--version', action = 'version',
+            version = '%(prog)s {}'.format(__version__))
+    parser.add_argument('--stats', action = 'store_true',
+            help = 'report times of phases, counts and the slowest files, and '
+            'whether the output was written')
+    parser.add_argument('--stats-format', choices = ['text', 'json'], default = 'text',
+            help = 'format of the --stats report (default: text)')
+    parser.add_argument('--stats-file', type = str, metavar = 'FILE',
+            help = 'write the --stats report to FILE instead of stderr')
+    parser.add_argument('--slowest', type = int, default = 10, metavar = 'N',
+            help = 'number of the slowest files in the --stats report (default: 10)')
+    parser.add_argument('--profile', type = str, metavar = 'FILE',
+            help = 'run under cProfile and save the profile to FILE (-: print it)')
+    parser.add_argument('--jobs', '-j', type = int, default = 1,
+            help = 'number of processes parsing the sources (0: all CPUs)')
+    parser.add_argument('--cache', type = str, default = '.fortdep-cache',
+            help = 'file to keep parsed sources between runs (default: .fortdep-cache)')
+    parser.add_argument('--no-cache', action = 'store_true',
+            help = 'parse all sources, do not read nor write the cache')
+    parser.add_argument('--exclude', '-x', action = 'append', default = [],
+            metavar = 'PATTERN', help = 'skip files and directories matching '
+            'the pattern (.gitignore syntax); may be given many times')
+    parser.add_argument('--watch', '-w', action = 'store_true',
+            help = 'keep running and update the output when sources change')
+    parser.add_argument('--debounce', type = float, default = 0.25,
+            metavar = 'SECONDS', help = 'in watch mode, wait until there are no '
+            'changes for that long before updating (default: 0.25)')
+    parser.add_argument('--format', '-f', choices = sorted(emitters), default = 'make',
+            help = 'output format (default: make)')
+    parser.add_argument('--timings', type = str, metavar = 'FILE',
+            help = 'compile times of objects for --format waves (lines '
+            '"object seconds" or JSON)')
+    parser.add_argument('--manifest', action = 'append', default = [],
+            metavar = 'FILE', help = 'modules of a prebuilt library (written '
+            'with --format manifest); may be given many times')
+    parser.add_argument('--manifest-path', action = 'append', default = [],
+            metavar = 'DIR', help = 'load all manifests (*{}) in DIR; also '
+            'taken from FORTDEP_MANIFEST_PATH'.format(manifest_suffix))
+    parser.add_argument('--library', type = str, metavar = 'NAME',
+            help = 'library file (or -lname) written to the manifest')
+    parser.add_argument('--encoding', '-e', type = str, default = 'utf-8',
+            dest = 'encoding', help = 'specify input encoding (default: utf-8)')
+    parser.add_argument('--output', '-o',
+            type = str, default = '--',
+            help = 'write output to file')
+    parser.set_defaults(merge = None)
+    if command == 'impact':
+        parser.add_argument('files', nargs = '+', metavar = 'FILE',
+            help = 'changed files')
+    elif command == 'merge':
+        parser.add_argument('merge', nargs = '+', metavar = 'FRAGMENT',
+            help = 'fragments (written with --format fragment), in the order '
+            'their sources would be scanned')
+        parser.set_defaults(path = [])
+    else:
+        parser.add_argument('path', nargs='*')
+
+    args = parser.parse_args(argv)
+    if args.watch and args.output == '--':
+        parser.error('--watch requires output file (-o)')
+    if args.watch and args.merge:
+        parser.error('--watch cannot be used with merge')
+    if args.fragments and args.format != 'make':
+        parser.error('--fragments can only be used with --format make')
+    if args.fragments and args.optimize:
+        parser.error('--fragments and --optimize cannot be used together')
+    if args.archives and (args.format != 'make' or args.fragments):
+        parser.error('--archives can only be used with --format make, without --fragments')
+    args.defines = preprocessor_defines(args.cppflags, args.macros)
+    return args
+
+def preprocessor_defines(cppflags, macros):
+    """
+    Macros for preprocessor conditionals: those given with -D and -U in
+    cppflags (flags of the compiler), then in macros, a list of ('D',
+    'NAME=VALUE') and ('U', 'NAME'). None if neither is given: all branches
+    of conditionals are scanned then.
+    """
+    if cppflags == None and not macros: return None
+    given = list()
+    if cppflags:
+        from shlex import split
+        words = split(cppflags)
+        for i, w in enumerate(words):
+            if w in ('-D', '-U') and i + 1 < len(words):
+                given.append((w[1], words[i + 1]))
+            elif w[:2] in ('-D', '-U') and len(w) > 2:
+                given.append((w[1], w[2:]))
+    defines = dict()
+    for kind, macro in given + list(macros):
+        name, eq, value = macro.partition('=')
+        if kind == 'D': defines[name] = value if eq else '1'
+        else: defines.pop(name, None)
+    return defines
+
+#------------------------------------------------------------------------------#
+
+def discover(args, cache = None):
+    """
+    Find the sources, either in directories from the command line, from
+    makefile VPATH or just recursively. Returns the list of (directory,
+    [file names]) and VPATH (or None).
+    """
+    make_vpath = None
+    if len(args.path) == 0:
+        make_vpath = read_makefile_vpath(cache, stderr if args.verbose else None)
+        inp = find_sources(make_vpath, args.exclude)
+    else:
+        inp = find_sources([ folder for arg in args.path \
+            for folder in arg.split(':') ], args.exclude)
+    return inp, make_vpath
+
+#------------------------------------------------------------------------------#
+
+def cache_key(args):
+    """everything that affects the results of scanning"""
+    key = [ __version__, cache_format, args.encoding ]
+    if args.defines != None:
+        key.append([ [name, value] for name, value in sorted(args.defines.items()) ])
+    return key
+
+#------------------------------------------------------------------------------#
+
+def build_graph(args, inp, cache = None, stats = None):
+    graph = DependencyGraph(args.encoding, args.verbose, stats = stats,
+        include_path = args.include_path, defines = args.defines)
+    graph.add_manifests(args.manifest, args.manifest_path + [ d for d in \
+        environ.get('FORTDEP_MANIFEST_PATH', '').split(':') if d ])
+    if args.merge:
+        for fn in args.merge: graph.add_fragment(fn)
+    else:
+        graph.add_files((path.join(reldir, fn) for reldir, filelist in inp \
+            for fn in filelist), cache, args.jobs)
+    return graph
+
+#------------------------------------------------------------------------------#
+
+def regenerate_command():
+    """
+    Shell command running fortdep again with the same arguments and the
+    variables of the environment which are used in the output.
+    """
+    from sys import argv, executable
+    from shlex import quote
+    env = [ '{}={}'.format(v, quote(environ[v])) for n, v, d in ninja_variables if v in environ ]
+    return ' '.join(env + [ quote(a) for a in [executable, path.abspath(argv[0])] + argv[1:] ])
+
+def emit(graph, output, args, make_vpath = None):
+    graph.emit(output, args.format, programs = args.programs,
+        includes = not args.no_includes, scaffold = args.whole,
+        vpath = make_vpath, interfaces = args.interfaces, moddir = args.moddir,
+        fragments = args.fragments, optimize = args.optimize, width = args.width,
+        archives = args.archives,
+        manifest = None if args.output == '--' else args.output,
+        command = regenerate_command() if args.format == 'ninja' else None,
+        library = args.library,
+        timings = load_timings(args.timings) if args.timings else None)
+
+#------------------------------------------------------------------------------#
+
+def main():
+    from sys import argv
+
+    if len(argv) > 1 and argv[1] == 'query':
+        exit(query_main(argv[2:]))
+
+    # main program starts here: parse command line args
+    command = argv[1] if len(argv) > 1 and argv[1] in ('serve', 'impact', 'merge') else None
+    args = parse_cmdline_args(argv[2:] if command else argv[1:], command)
+
+    #--------------------------------------------------------------------------#
+
+    if command == 'impact':
+        exit(impact_main(args))
+
+    if args.watch or command == 'serve':
+        cache = ParseCache(None if args.no_cache else args.cache, cache_key(args))
+        try:
+            if command == 'serve':
+                serve(args, cache)
+            else:
+                watch_output(args, cache)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.profile:
+        # the whole run under cProfile; '-' prints the top of the profile
+        import cProfile, pstats
+        profile = cProfile.Profile()
+        profile.runcall(run, args)
+        if args.profile == '-':
+            pstats.Stats(profile, stream = stderr).sort_stats('cumulative').print_stats(30)
+        else:
+            profile.dump_stats(args.profile)
+    else:
+        run(args)
+
+#------------------------------------------------------------------------------#
+
+def run(args):
+    """generate the output as given by the command line arguments"""
+    from contextlib import nullcontext
+    stats = Stats() if args.stats else None
+    timed = lambda name: stats.phase(name) if stats else nullcontext()
+
+    cache = None if args.no_cache or args.merge \
+        else ParseCache(args.cache, cache_key(args))
+
+    if args.merge:
+        # sources were scanned by the runs which wrote the fragments
+        inp, make_vpath = None, None
+    else:
+        with timed('discovery'):
+            inp, make_vpath = discover(args, cache)
+        if len(args.path) == 0:
+            if make_vpath:
+                stderr.write('found Makefile, using directories: {}\n'.format(", ".join(make_vpath)))
+            else:
+                stderr.write(u'no directories given; scanning recursively...\n')
+
+    #--------------------------------------------------------------------------#
+
+    # scanning files complete, now analyze filenames and parse each foratran source
+    graph = build_graph(args, inp, cache, stats)
+
+    if stats:
+        stats.counts['jobs'] = args.jobs
+        stats.count('units', len(graph.universe))
+        stats.count('edges', sum(len(u.deps) for u in graph.universe))
+        if graph.programs() and (args.programs or args.whole or args.format != 'make'):
+            with timed('closure'):
+                graph.closures()
+
+    #--------------------------------------------------------------------------#
+
+    with timed('emission'):
+        if args.output == '--':
+            emit(graph, stdout, args, make_vpath)
+            written = None
+        else:
+            # included makefiles with a new mtime make GNU make start over, so
+            # the file is written (atomically) only if the content is different
+            from io import StringIO
+            buf = StringIO()
+            emit(graph, buf, args, make_vpath)
+            written = write_if_changed(args.output, buf.getvalue())
+
+    if stats:
+        stats.counts['output'] = 'stdout' if written == None \
+            else ('written' if written else 'unchanged')
+        if args.stats_file:
+            with open(args.stats_file, 'w', encoding = 'utf-8') as f:
+                stats.write(f, args.stats_format, args.slowest)
+        else:
+            stats.write(stderr, args.stats_format, args.slowest)
+
     #--------------------------------------------------------------------------#
-    if verbose:
+    if args.verbose:
         stderr.write('\n')
-        for u in universe:
+        for u in graph.universe:
             stderr.write(u.summ() + '\n')
 
 #------------------------------------------------------------------------------#
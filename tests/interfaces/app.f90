@@ -0,0 +1,9 @@
+module app
+  use base
+  use lib
+  implicit none
+contains
+  subroutine run
+    call report(helper(1.0))
+  end subroutine
+end module
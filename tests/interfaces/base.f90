@@ -0,0 +1,15 @@
+module base
+  implicit none
+  interface
+    module function compute(x) result(y)
+      real, intent(in) :: x
+      real :: y
+    end function
+  end interface
+contains
+  function helper(x) result(y)
+    real, intent(in) :: x
+    real :: y
+    y = 2 * x
+  end function
+end module
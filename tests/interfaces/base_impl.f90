@@ -0,0 +1,9 @@
+submodule (base) base_impl
+  implicit none
+contains
+  module function compute(x) result(y)
+    real, intent(in) :: x
+    real :: y
+    y = helper(x) + 1
+  end function
+end submodule
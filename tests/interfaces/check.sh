@@ -0,0 +1,48 @@
+#!/bin/sh
+# Counts objects compiled again after changing the sources, with
+# dependencies on objects and with dependencies on module interfaces.
+# Fails if depending on interfaces does not save any compilation.
+
+set -e
+here=$(cd "$(dirname "$0")" && pwd)
+work=$(mktemp -d)
+trap 'rm -rf "$work"' EXIT
+
+# change: file and sed expression
+changes="
+base_impl.f90 s/helper(x) + 1/helper(x) + 2/
+base.f90 s/y = 2 \* x/y = 3 * x/
+base.f90 s/^contains/  integer, parameter :: version = 2\ncontains/
+"
+
+rebuilt() {
+    make -C "$work" FORTDEP="python3 $here/../../fortdep2.py" MODE="$1" \
+        | grep -c -- ' -c ' || true
+}
+
+printf '%-16s %-58s %8s %10s\n' file change objects interfaces
+printf "%s\n" "$changes" | while read -r file expr; do
+    [ -n "$file" ] || continue
+    for mode in objects interfaces; do
+        opt=$([ $mode = interfaces ] && echo --interfaces || true)
+        rm -rf "$work"/*
+        cp "$here"/*.f90 "$here"/Makefile "$work"
+        rebuilt "$opt" > /dev/null
+        # make sure the timestamps differ
+        sleep 1
+        sed -i "$expr" "$work/$file"
+        eval "n_$mode=\$(rebuilt \"\$opt\")"
+        "$work/main" > /dev/null
+    done
+    printf '%-16s %-58s %8s %10s\n' "$file" "$expr" "$n_objects" "$n_interfaces"
+    if [ "$n_interfaces" -gt "$n_objects" ]; then
+        echo "error: more objects compiled with --interfaces" >&2; exit 1
+    fi
+    echo "$n_objects $n_interfaces" >> "$work.counts"
+done
+
+saved=$(awk '$2 < $1' "$work.counts" | wc -l)
+rm -f "$work.counts"
+if [ "$saved" -eq 0 ]; then
+    echo "error: --interfaces did not save any compilation" >&2; exit 1
+fi
@@ -0,0 +1,9 @@
+module lib
+  use base
+  implicit none
+contains
+  subroutine report(x)
+    real, intent(in) :: x
+    print *, 'compute', x, compute(x)
+  end subroutine
+end module
@@ -0,0 +1,5 @@
+program main
+  use app
+  implicit none
+  call run
+end program
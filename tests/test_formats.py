@@ -0,0 +1,220 @@
+# coding: utf-8
+"""
+Output formats besides the makefile, checked on tests/example and on
+generated trees: fragments of shards and their merge, the answers of
+fortdep2 impact, build waves and ninja files.
+Run with: python -m unittest discover tests
+"""
+
+from os import path, listdir, getcwd, chdir
+from io import StringIO
+from tempfile import TemporaryDirectory
+from subprocess import run, PIPE
+import json
+import unittest
+import sys
+
+here = path.dirname(path.abspath(__file__))
+example = path.join(here, 'example')
+root = path.dirname(here)
+script = path.join(root, 'fortdep2.py')
+sys.path.insert(0, root)
+from bench.generate import generate
+from fortdep2 import DependencyGraph
+
+def fortdep2(cwd, *argv):
+    argv = list(argv)
+    # options go after the command (merge...), if there is one
+    at = 1 if argv and argv[0] in ('merge', 'impact') else 0
+    argv.insert(at, '--no-cache')
+    return run([sys.executable, script] + argv, cwd = cwd,
+        stdout = PIPE, stderr = PIPE, universal_newlines = True)
+
+class Tree(unittest.TestCase):
+    """tests on a generated tree, with sources in several directories"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        cls.tree = path.join(cls.tmp.name, 'tree')
+        generate(cls.tree, files = 300, programs = 10, submodules = 0.2, includes = 0.2)
+        # directories with sources, in the order a recursive search takes them
+        cls.dirs = [ d for d in ('prog', 'src/d0', 'src/d1', 'src/d2')
+            if path.isdir(path.join(cls.tree, d)) ]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def output(self, *argv):
+        p = fortdep2(self.tree, *argv)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        return p.stdout
+
+    def graph(self):
+        graph = DependencyGraph(log = StringIO())
+        cwd = getcwd()
+        chdir(self.tree)
+        try:
+            graph.add_paths()
+        finally:
+            chdir(cwd)
+        return graph
+
+#------------------------------------------------------------------------------#
+
+class Merge(Tree):
+
+    def test_shards(self):
+        self.assertGreater(len(self.dirs), 2)
+        for shards in ([ self.dirs ], [ self.dirs[:1], self.dirs[1:] ],
+                [ [ d ] for d in self.dirs ]):
+            fragments = list()
+            for i, dirs in enumerate(shards):
+                fn = path.join(self.tmp.name, 'shard{}.json'.format(i))
+                self.output('-f', 'fragment', '-o', fn, *dirs)
+                fragments.append(fn)
+            for options in ([ '-p' ], [ '-s', '--interfaces' ], [ '-p', '-O', '2' ],
+                    [ '-f', 'json' ], [ '-p', '--archives' ]):
+                self.assertEqual(self.output('merge', *(options + fragments)),
+                    self.output(*(options + self.dirs)), ' '.join(options))
+
+    def test_duplicate(self):
+        fn = path.join(self.tmp.name, 'twice.json')
+        self.output('-f', 'fragment', '-o', fn, self.dirs[-1])
+        p = fortdep2(self.tree, 'merge', fn, fn)
+        self.assertNotEqual(p.returncode, 0)
+        self.assertIn('already assigned', p.stderr)
+
+#------------------------------------------------------------------------------#
+
+class Impact(unittest.TestCase):
+
+    def impact(self, *argv):
+        p = fortdep2(example, 'impact', '--json', *argv)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        return json.loads(p.stdout)
+
+    def test_source(self):
+        self.assertEqual(self.impact('m3.f90'), dict(programs = [ 'prog1', 'prog2' ],
+            objects = { 'm3.o': 0, 'm2.o': 1, 'm11.o': 1, 'prog1.o': 1, 'prog2.o': 1,
+                'm1.o': 2 }))
+        self.assertEqual(self.impact('--depth', '1', 'm3.f90')['objects'],
+            { 'm3.o': 0, 'm2.o': 1, 'm11.o': 1, 'prog1.o': 1, 'prog2.o': 1 })
+        # a submodule is only linked again
+        self.assertEqual(self.impact('m11.f90'), dict(programs = [ 'prog1' ],
+            objects = { 'm11.o': 0 }))
+
+    def test_included(self):
+        self.assertEqual(self.impact('i2.f90')['objects'], { 'm3.o': 0, 'm2.o': 1,
+            'm11.o': 1, 'prog1.o': 1, 'prog2.o': 1, 'm1.o': 2 })
+
+    def test_text(self):
+        p = fortdep2(example, 'impact', 'prog2.f90')
+        self.assertEqual(p.stdout, 'objects: prog2.o\nprograms: prog2\n')
+
+#------------------------------------------------------------------------------#
+
+class Waves(Tree):
+
+    def test_example(self):
+        p = fortdep2(example, '-f', 'waves', '.')
+        self.assertEqual(p.stdout.split('\n\n')[0].split('\n')[1:], [
+            'wave 0 (1): m3.o', 'wave 1 (1): m2.o', 'wave 2 (2): m1.o prog2.o',
+            'wave 3 (2): m11.o prog1.o' ])
+        self.assertIn('# critical path: 4 objects, 4.00 s of 6.00 s total', p.stdout)
+
+    def test_timings(self):
+        with TemporaryDirectory(prefix = 'fortdep-test-') as tmp:
+            fn = path.join(tmp, 'timings.txt')
+            with open(fn, 'w') as f:
+                f.write('prog2.o 10  # the slowest\nm3.o 1\nm2.o 3\n')
+            p = fortdep2(example, '-f', 'waves', '--timings', fn, '.')
+        # objects without a time take the median, 3 s
+        self.assertIn('# critical path: 3 objects, 14.00 s of 23.00 s total', p.stdout)
+        self.assertIn('\nm3.o 1.00\nm2.o 3.00\nprog2.o 10.00\n', p.stdout)
+
+    def test_tree(self):
+        graph = self.graph()
+        objects = graph.object_dependencies(includes = False)
+        timings = dict((obj, float(len(obj))) for obj in sorted(objects)[::3])
+        s = graph.schedule(timings)
+        self.assertEqual(s['cycles'], [])
+        wave = dict((obj, i) for i, w in enumerate(s['waves']) for obj in w)
+        self.assertEqual(set(wave), set(objects))
+        for obj, deps in objects.items():
+            for d in deps:
+                self.assertLess(wave[d], wave[obj])
+                self.assertGreaterEqual(s['priority'][d], s['times'][d] + s['priority'][obj])
+        # the critical path is a chain of dependencies, as long as any other
+        chain = s['critical_path']
+        for before, after in zip(chain, chain[1:]):
+            self.assertIn(before, objects[after])
+        self.assertAlmostEqual(s['critical_time'], sum(s['times'][o] for o in chain))
+        self.assertAlmostEqual(s['critical_time'], max(s['priority'].values()))
+        self.assertAlmostEqual(s['total_time'], sum(s['times'].values()))
+
+#------------------------------------------------------------------------------#
+
+def ninja_edges(text):
+    """build edges of a ninja file: (outputs, implicit outputs, rule, inputs, implicit inputs)"""
+    def split(words):
+        i = words.index('|') if '|' in words else len(words)
+        return words[:i], words[i + 1:]
+    edges = list()
+    for line in text.split('\n'):
+        if not line.startswith('build '): continue
+        outs, ins = line[len('build '):].split(': ', 1)
+        ins = ins.split()
+        edges.append(split(outs.split()) + (ins[0],) + split(ins[1:]))
+    return edges
+
+class Ninja(Tree):
+
+    def test_example(self):
+        edges = ninja_edges(fortdep2(example, '-f', 'ninja', '.').stdout)
+        self.assertIn((['m3.o'], ['m3.mod', 'm4.mod'], 'fc', ['m3.f90'], ['i1.f90', 'i2.f90']),
+            edges)
+        self.assertIn((['m11.o'], [], 'fc', ['m11.f90'], ['m1.smod', 'm3.mod']), edges)
+        self.assertIn((['prog2'], [], 'link', ['m2.o', 'm3.o', 'prog2.o'], []), edges)
+
+    def test_tree(self):
+        text = self.output('-f', 'ninja', '--no-includes')
+        self.assertIn('restat = 1', text)
+        edges = ninja_edges(text)
+        written = dict((o, e) for e in edges for o in e[0] + e[1])
+        self.assertEqual(len(written), sum(len(e[0]) + len(e[1]) for e in edges))
+        graph = self.graph()
+        objects = graph.object_dependencies(includes = False)
+        links = dict((p.objfile.fnexe, set(graph.link_objects(p))) for p in graph.programs())
+        self.assertEqual(len(links), 10)
+        for outs, implicit_outs, rule, ins, implicit_ins in edges:
+            if rule == 'link':
+                self.assertEqual(set(ins), links[outs[0]])
+                continue
+            # module files read are written by the edges of the objects before
+            self.assertEqual(set(written[f][0][0] for f in implicit_ins), objects[outs[0]])
+            self.assertEqual(len(ins), 1)
+        self.assertEqual(set(o for e in edges if e[2] != 'link' for o in e[0]), set(objects))
+
+    def test_regenerate(self):
+        with TemporaryDirectory(prefix = 'fortdep-test-') as tmp:
+            fn = path.join(tmp, 'build.ninja')
+            p = fortdep2(example, '-f', 'ninja', '-o', fn, '.')
+            self.assertEqual(p.returncode, 0, p.stderr)
+            with open(fn) as f: text = f.read()
+        self.assertIn('rule fortdep\n', text)
+        self.assertIn('  generator = 1\n', text)
+        edge = [ e for e in ninja_edges(text) if e[2] == 'fortdep' ]
+        self.assertEqual(edge, [ ([ fn ], [], 'fortdep', [], [ 'm1.f90', 'm11.f90',
+            'm2.f90', 'm3.f90', 'prog1.f90', 'prog2.f90' ]) ])
+
+    def test_empty(self):
+        with TemporaryDirectory(prefix = 'fortdep-test-') as tmp:
+            p = fortdep2(tmp, '-f', 'ninja')
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertEqual(ninja_edges(p.stdout), [])
+        self.assertNotIn('default', p.stdout)
+
+if __name__ == '__main__':
+    unittest.main()
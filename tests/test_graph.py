@@ -0,0 +1,323 @@
+# coding: utf-8
+"""
+The dependency graph built from sources: adding files, closures (against
+the recursive walktree of the first version), included files, impact,
+manifests of prebuilt libraries and static libraries of directories.
+Run with: python -m unittest discover tests
+"""
+
+from os import path, getcwd, chdir, makedirs
+from io import StringIO
+from tempfile import TemporaryDirectory
+import random
+import unittest
+import sys
+
+here = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.dirname(here))
+from fortdep2 import DependencyGraph, walktree, load_manifest, linked_units
+import json
+
+example = path.join(here, 'example')
+
+def emitted(graph, format = 'make', **options):
+    buf = StringIO()
+    graph.emit(buf, format, **options)
+    return buf.getvalue()
+
+#------------------------------------------------------------------------------#
+
+class AddSource(unittest.TestCase):
+
+    def test_duplicate_leaves_graph_unchanged(self):
+        graph = DependencyGraph(log = StringIO())
+        graph.add_source('a.f90', 'module a\nend module\n')
+        graph.add_source('b.f90', 'module b\nuse a\nend module\nprogram p\nuse b\nend program\n')
+        before = emitted(graph, programs = True)
+        objfiles = list(graph.objfiles)
+        modules = sorted(graph.universe.modules)
+        for content in ('module c\nuse z\nend module\nmodule a\nend module\n',
+                'module c\nend module\nmodule c\nend module\n',
+                'submodule (a) b\nend submodule\n'):
+            with self.assertRaises(Exception):
+                graph.add_source('c.f90', content)
+            self.assertEqual(graph.objfiles, objfiles)
+            self.assertEqual(sorted(graph.universe.modules), modules)
+            self.assertEqual(emitted(graph, programs = True), before)
+        # and the graph is still usable
+        graph.add_source('c.f90', 'module c\nuse a\nend module\n')
+        self.assertEqual(graph.provider('c').fnsrc, 'c.f90')
+
+#------------------------------------------------------------------------------#
+
+def walktree_recursive(u, bag = set()):
+    """walktree of the first version of fortdep2, as a reference"""
+    harvest = set((u,))
+    deps = set(filter(lambda x: x.objfile != None, u.deps))
+    if hasattr(u, 'submodules'):
+        deps |= set(filter(lambda x: x.objfile != None, u.submodules))
+    new_bag = bag | deps | set((u,))
+    for d in deps:
+        if not d in bag:
+            harvest |= walktree_recursive(d, new_bag)
+    return harvest
+
+def random_sources(n, seed):
+    """sources of n modules using each other at random (with cycles), and programs"""
+    rnd = random.Random(seed)
+    sources = dict()
+    for i in range(n):
+        uses = rnd.sample(range(n), rnd.randint(0, 3))
+        sources['m{}.f90'.format(i)] = 'module m{}\n{}end module\n'.format(i,
+            ''.join('use m{}\n'.format(j) for j in uses if j != i))
+        if rnd.random() < 0.2:
+            sources['s{}.f90'.format(i)] = 'submodule (m{0}) s{0}\nuse m{1}\nend submodule\n' \
+                .format(i, rnd.randrange(n))
+    for i in range(n // 5):
+        sources['p{}.f90'.format(i)] = 'program p{}\n{}end program\n'.format(i,
+            ''.join('use m{}\n'.format(j) for j in rnd.sample(range(n), 2)))
+    return sources
+
+class Closures(unittest.TestCase):
+
+    def check(self, graph):
+        closures = graph.closures()
+        self.assertEqual(set(closures), set(graph.programs()))
+        for p in graph.programs():
+            self.assertEqual(closures[p], walktree_recursive(p))
+            self.assertEqual(walktree(p), walktree_recursive(p))
+
+    def test_example(self):
+        graph = DependencyGraph(log = StringIO())
+        graph.add_paths([example])
+        self.assertEqual(len(graph.programs()), 2)
+        self.check(graph)
+
+    def test_random(self):
+        sizes = list()
+        for seed in range(10):
+            graph = DependencyGraph(log = StringIO())
+            for fn, content in sorted(random_sources(30, seed).items()):
+                graph.add_source(fn, content)
+            self.check(graph)
+
+    def test_deep_chain(self):
+        graph = DependencyGraph(log = StringIO())
+        n = 5000
+        for i in range(n):
+            graph.add_source('m{}.f90'.format(i), 'module m{}\n{}end module\n'.format(i,
+                'use m{}\n'.format(i + 1) if i + 1 < n else ''))
+        graph.add_source('p.f90', 'program p\nuse m0\nend program\n')
+        self.assertEqual(len(graph.link_objects('p')), n + 1)
+
+#------------------------------------------------------------------------------#
+
+class InTree(unittest.TestCase):
+    """tests on files written to a temporary directory"""
+
+    files = dict()
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        self.cwd = getcwd()
+        chdir(self.tmp.name)
+        for fn, text in self.files.items():
+            makedirs(path.dirname(fn) or '.', exist_ok = True)
+            with open(fn, 'w') as f: f.write(text)
+
+    def tearDown(self):
+        chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def build(self, dirs, **options):
+        graph = DependencyGraph(log = StringIO(), **options)
+        graph.add_paths(dirs)
+        return graph
+
+class Includes(InTree):
+
+    files = {
+        'src/a.f90': 'module a\ninclude "defs.inc"\nend module\n',
+        'src/b.f90': 'module b\ninclude "common.inc"\ninclude "nowhere.inc"\nend module\n',
+        'src/c.f90': 'module c\nend module\n',
+        'src/defs.inc': 'include "common.inc"\n',
+        'inc/common.inc': 'use c\ninclude "deep.inc"\n',
+        'inc/defs.inc': '! not this one, src/defs.inc is found first\n',
+        'inc/deep.inc': 'include "deep.inc"\n',
+    }
+
+    def test_resolved(self):
+        graph = self.build(['src'], include_path = ['inc'])
+        deps = graph.object_dependencies()
+        self.assertEqual(deps['a.o'], set([ 'src/defs.inc', 'inc/common.inc',
+            'inc/deep.inc', 'c.o' ]))
+        # names which are not found are kept as they are
+        self.assertEqual(deps['b.o'], set([ 'inc/common.inc', 'inc/deep.inc',
+            'nowhere.inc', 'c.o' ]))
+
+    def test_without_search_path(self):
+        deps = self.build(['src']).object_dependencies()
+        self.assertEqual(deps['a.o'], set([ 'src/defs.inc', 'common.inc' ]))
+        self.assertEqual(deps['b.o'], set([ 'common.inc', 'nowhere.inc' ]))
+
+#------------------------------------------------------------------------------#
+
+class Impact(InTree):
+
+    files = {
+        'a/defs.inc': 'integer, parameter :: n = 1\n',
+        'b/defs.inc': 'integer, parameter :: n = 2\n',
+        'a/ma.f90': 'module ma\ninclude "defs.inc"\nend module\n',
+        'a/mc.f90': 'module mc\ninclude "missing.inc"\nend module\n',
+        'b/mb.f90': 'module mb\ninclude "defs.inc"\nend module\n',
+        'b/mu.f90': 'module mu\nuse mb\nend module\n',
+        'b/prog.f90': 'program prog\nuse mu\nuse ma\nend program\n',
+    }
+
+    def setUp(self):
+        InTree.setUp(self)
+        self.graph = self.build(['a', 'b'])
+
+    def test_sources(self):
+        impact = self.graph.impact(['b/mb.f90'])
+        self.assertEqual(impact['objects'], { 'mb.o': 0, 'mu.o': 1, 'prog.o': 2 })
+        self.assertEqual(impact['programs'], [ 'prog' ])
+        self.assertEqual(self.graph.impact(['b/mb.f90'], depth = 1)['objects'],
+            { 'mb.o': 0, 'mu.o': 1 })
+
+    def test_included_by_path(self):
+        # files including another defs.inc are not affected
+        self.assertEqual(self.graph.impact(['a/defs.inc'])['objects'], { 'ma.o': 0, 'prog.o': 1 })
+        self.assertEqual(sorted(self.graph.impact(['b/defs.inc'])['objects']),
+            [ 'mb.o', 'mu.o', 'prog.o' ])
+
+    def test_included_not_found(self):
+        self.assertEqual(self.graph.impact(['elsewhere/missing.inc'])['objects'],
+            { 'mc.o': 0 })
+
+#------------------------------------------------------------------------------#
+
+class Manifests(InTree):
+
+    files = {
+        'solver/la.f90': 'module la\nend module\n',
+        'solver/solver.f90': 'module solver\nuse la\nend module\n'
+            'submodule (solver) impl\nend submodule\n',
+        'app/main.f90': 'program main\nuse solver\nuse iso_fortran_env\nend program\n',
+        'app/other.f90': 'program other\nuse iso_c_binding\nend program\n',
+        'app/broken.f90': 'program broken\nuse nowhere\nend program\n',
+    }
+
+    def setUp(self):
+        InTree.setUp(self)
+        graph = self.build(['solver'])
+        makedirs('lib')
+        with open('lib/solver.fortdep.json', 'w') as f:
+            f.write(emitted(graph, 'manifest', library = 'libsolver.a'))
+        with open('lib/libsolver.a', 'w') as f: pass
+
+    def test_manifest(self):
+        data = load_manifest('lib/solver.fortdep.json')
+        self.assertEqual(data['library'], 'libsolver.a')
+        self.assertEqual(data['modules'], { 'la': 'la.o', 'solver': 'solver.o', 'impl': 'solver.o' })
+        self.assertEqual(data['submodules'], { 'solver': [ 'impl' ] })
+        with open('app/main.f90', 'w') as f: f.write('{}\n')
+        with self.assertRaises(Exception):
+            load_manifest('app/main.f90')
+
+    def test_libraries(self):
+        graph = self.build(['app'])
+        graph.add_manifests(dirs = ['lib'])
+        # neither modules of the library nor intrinsic modules are missing
+        self.assertEqual([ m.name for m in graph.missing() ], [ 'nowhere' ])
+        self.assertEqual(graph.libraries('main'), set([ 'lib/libsolver.a' ]))
+        self.assertEqual(graph.libraries('other'), set())
+        self.assertEqual(json.loads(emitted(graph, 'json'))['programs']['main']['libraries'],
+            [ 'lib/libsolver.a' ])
+        self.assertIn('LDLIBS := lib/libsolver.a\n', emitted(graph, scaffold = True))
+
+    def test_without_manifest(self):
+        graph = self.build(['app'])
+        self.assertEqual(sorted(m.name for m in graph.missing()), [ 'nowhere', 'solver' ])
+        self.assertEqual(graph.libraries('main'), set())
+
+#------------------------------------------------------------------------------#
+
+class Archives(InTree):
+
+    files = {
+        'src/io/io.f90': 'module io\nend module\n',
+        'src/solver/la.f90': 'module la\nuse io\nend module\n',
+        'src/solver/solver.f90': 'module solver\nuse la\nend module\n',
+        # x and y need each other
+        'src/x/a.f90': 'module a\nuse b\nend module\n',
+        'src/x/d.f90': 'module d\nend module\n',
+        'src/y/b.f90': 'module b\nend module\n',
+        'src/y/c.f90': 'module c\nuse d\nend module\n',
+        'prog/main.f90': 'program main\nuse solver\nuse a\nend program\n',
+        'prog/tool.f90': 'program tool\nuse io\nuse helper\nend program\n'
+            'module helper\nend module\n',
+    }
+
+    dirs = [ 'prog', 'src/io', 'src/solver', 'src/x', 'src/y' ]
+
+    def check(self, graph):
+        """each program is linked from all of its objects, archives before those they need"""
+        members = graph.archives()
+        archive_of = dict((obj, a) for a, objs in members.items() for obj in objs)
+        for p in graph.programs():
+            linked = graph.link_archives(p)
+            objects = [ x for x in linked if x not in members ]
+            archives = [ x for x in linked if x in members ]
+            self.assertEqual(linked, objects + archives)
+            self.assertEqual(len(archives), len(set(archives)))
+            self.assertTrue(all(x not in archive_of for x in objects))
+            self.assertTrue(graph.link_objects(p) <= \
+                set(objects).union(*(members[a] for a in archives)))
+            for u in graph.closures()[p]:
+                a = archive_of.get(u.objfile.fnobj)
+                if a == None: continue
+                for x in linked_units(u):
+                    b = archive_of.get(x.objfile.fnobj)
+                    if b != None and b != a:
+                        self.assertLess(archives.index(a), archives.index(b))
+
+    def test_archives(self):
+        graph = self.build(self.dirs)
+        self.assertEqual(graph.archives(), {
+            'libsrc_io.a': set([ 'io.o' ]),
+            'libsrc_solver.a': set([ 'la.o', 'solver.o' ]),
+            'libsrc.a': set([ 'a.o', 'b.o', 'c.o', 'd.o' ]) })
+        self.assertEqual(graph.link_archives('main'),
+            [ 'main.o', 'libsrc.a', 'libsrc_solver.a', 'libsrc_io.a' ])
+        # a module in the file of a program is not put to a library
+        self.assertEqual(graph.link_archives('tool'), [ 'tool.o', 'libsrc_io.a' ])
+        self.check(graph)
+
+    def test_makefile(self):
+        graph = self.build(self.dirs)
+        text = emitted(graph, programs = True, archives = True)
+        self.assertIn('libsrc_solver.a: la.o solver.o\n', text)
+        self.assertIn('tool: tool.o libsrc_io.a\n', text)
+
+    def test_random(self):
+        sizes = list()
+        for seed in range(10):
+            rnd = random.Random(seed)
+            graph = DependencyGraph(log = StringIO())
+            # modules of 6 directories use modules before them, and few after
+            for i in range(60):
+                uses = [ j for j in rnd.sample(range(60), 3) if j < i or rnd.random() < 0.01 ]
+                graph.add_source('d{}/m{}.f90'.format(i // 10, i), 'module m{}\n{}end module\n'
+                    .format(i, ''.join('use m{}\n'.format(j) for j in uses)))
+            for i in range(10):
+                graph.add_source('p{}.f90'.format(i), 'program p{}\nuse m{}\nend program\n'
+                    .format(i, rnd.randrange(60)))
+            sizes.append(len(graph.archives()))
+            self.check(graph)
+        # libraries of single directories, and merged ones
+        self.assertEqual(max(sizes), 6)
+        self.assertLess(min(sizes), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+VPATH read from makefiles without running make, and the cases where make
+must be asked. Run with: python -m unittest discover tests
+"""
+
+from os import path, getcwd, chdir, makedirs
+from tempfile import TemporaryDirectory
+import unittest
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import fortdep2
+
+#------------------------------------------------------------------------------#
+
+class ReadMakefileVpath(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        self.cwd = getcwd()
+        chdir(self.tmp.name)
+        makedirs('debug')
+        makedirs('release')
+        # what running make would answer, recorded instead
+        self.make_called = list()
+        self.check = fortdep2.check_makefile_vpath
+        fortdep2.check_makefile_vpath = lambda: self.make_called.append(True) or ['make']
+
+    def tearDown(self):
+        fortdep2.check_makefile_vpath = self.check
+        chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def vpath(self, text):
+        with open('Makefile', 'w') as f:
+            f.write(text)
+        return fortdep2.read_makefile_vpath()
+
+    def test_simple(self):
+        self.assertEqual(self.vpath('SRC = debug\nVPATH = $(SRC):release\n'),
+            ['debug', 'release'])
+        self.assertFalse(self.make_called)
+
+    def test_curdir(self):
+        self.assertEqual(self.vpath('VPATH = $(CURDIR)/debug\n'),
+            [path.join(getcwd(), 'debug')])
+        self.assertFalse(self.make_called)
+
+    def test_make_variables(self):
+        self.assertEqual(self.vpath('VPATH = $(MAKEFILE_LIST)\n'), ['make'])
+        self.assertEqual(self.vpath('VPATH = $(.VARIABLES)\n'), ['make'])
+
+    def test_conditional_vpath(self):
+        self.assertEqual(self.vpath('ifdef DEBUG\nVPATH = debug\nendif\n'), ['make'])
+
+    def test_conditional_reference(self):
+        text = 'DEBUG ?= 1\nifeq ($(DEBUG),1)\nSRC = debug\nelse\nSRC = release\nendif\n'
+        self.assertEqual(self.vpath(text + 'VPATH = $(SRC)\n'), ['make'])
+        # also through a simple variable expanded outside the conditional
+        self.assertEqual(self.vpath(text + 'DIR := $(SRC)\nVPATH = $(DIR)\n'), ['make'])
+
+    def test_conditional_unrelated(self):
+        text = 'ifdef DEBUG\nFFLAGS = -g\nendif\nVPATH = release\n'
+        self.assertEqual(self.vpath(text), ['release'])
+        self.assertFalse(self.make_called)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+Preprocessor conditionals: the expressions of #if and the branches which
+preprocess keeps. Run with: python -m unittest discover tests
+"""
+
+from os import path
+import unittest
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from fortdep2 import cpp_evaluate, preprocess
+
+#------------------------------------------------------------------------------#
+
+class CppEvaluate(unittest.TestCase):
+
+    def test_arithmetic(self):
+        self.assertEqual(cpp_evaluate('1 + 2 * 3', {}), 7)
+        self.assertEqual(cpp_evaluate('(1 + 2) * 3', {}), 9)
+        self.assertEqual(cpp_evaluate('-7 / 2', {}), -3)
+        self.assertEqual(cpp_evaluate('-7 % 2', {}), -1)
+        self.assertEqual(cpp_evaluate('0x10 == 16 && 010 == 8', {}), 1)
+        self.assertEqual(cpp_evaluate('1 << 4 | 1', {}), 17)
+
+    def test_macros(self):
+        defines = dict(NPROC = '16', TWICE = 'NPROC * 2')
+        self.assertEqual(cpp_evaluate('TWICE', defines), 32)
+        self.assertEqual(cpp_evaluate('UNDEFINED', defines), 0)
+        self.assertEqual(cpp_evaluate('defined(NPROC) && !defined UNDEFINED', defines), 1)
+
+    def test_short_circuit(self):
+        expr = 'defined(NPROC) && (64 / NPROC > 2)'
+        self.assertEqual(cpp_evaluate(expr, dict(USE_GPU = '1')), 0)
+        self.assertEqual(cpp_evaluate(expr, dict(NPROC = '16')), 1)
+        self.assertEqual(cpp_evaluate('!defined(NPROC) || 64 % NPROC', {}), 1)
+
+    def test_cannot_evaluate(self):
+        for expr in ('64 / NPROC', '64 % 0', 'VERSION(3)', '1 +', '(1', '1 ? 2 : 3'):
+            with self.assertRaises(ValueError, msg = expr):
+                cpp_evaluate(expr, {})
+
+#------------------------------------------------------------------------------#
+
+class Preprocess(unittest.TestCase):
+
+    source = b'\n'.join([
+        b'module m',
+        b'#ifdef USE_MPI',
+        b'  use mpi',
+        b'#elif defined(NPROC) && (64 / NPROC > 2)',
+        b'  use threads',
+        b'#else',
+        b'  use serial',
+        b'#endif',
+        b'end module',
+    ])
+
+    def kept(self, defines):
+        return [ l.strip() for l in preprocess(self.source, defines).split(b'\n')
+            if l.startswith(b'  use') ]
+
+    def test_branches(self):
+        self.assertEqual(self.kept(dict(USE_MPI = '1')), [ b'use mpi' ])
+        self.assertEqual(self.kept(dict(NPROC = '16')), [ b'use threads' ])
+        self.assertEqual(self.kept(dict(NPROC = '64')), [ b'use serial' ])
+        self.assertEqual(self.kept(dict()), [ b'use serial' ])
+
+    def test_lines_kept(self):
+        self.assertEqual(preprocess(self.source, {}).count(b'\n'), self.source.count(b'\n'))
+
+    def test_unknown_keeps_all(self):
+        source = b'#if 64 / NPROC > 2\n  use threads\n#else\n  use serial\n#endif\n'
+        self.assertEqual(preprocess(source, {}).split(b'\n')[1:4:2],
+            [ b'  use threads', b'  use serial' ])
+
+    def test_define(self):
+        source = b'#define USE_MPI\n#ifdef USE_MPI\n  use mpi\n#endif\n#undef USE_MPI\n' \
+            b'#ifdef USE_MPI\n  use other\n#endif\n'
+        self.assertEqual([ l for l in preprocess(source, {}).split(b'\n') if l ],
+            [ b'  use mpi' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# coding: utf-8
+"""
+Makefile rules: the compressor behind -O and its check, and the folding
+of long lines. Run with: python -m unittest discover tests
+"""
+
+from os import path, getcwd, chdir
+from io import StringIO
+from tempfile import TemporaryDirectory
+import random
+import unittest
+import sys
+
+here = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.dirname(here))
+import fortdep2
+from fortdep2 import DependencyGraph, compress_rules, expand_rules, FoldWriter
+from fortdep import fold
+from bench.generate import generate
+
+def random_rules(rnd, n):
+    """rules of n targets, many of them sharing prerequisites"""
+    shared = [ set(rnd.sample(range(40), rnd.randint(1, 12))) for i in range(5) ]
+    rules = list()
+    for t in range(n):
+        prereqs = set(rnd.sample(range(40), rnd.randint(0, 6)))
+        if rnd.random() < 0.6: prereqs |= rnd.choice(shared)
+        if rnd.random() < 0.3: prereqs = set(rnd.choice(shared))
+        rules.append(([ 't{}'.format(t) ], [ 'p{}'.format(p) for p in prereqs ]))
+    return rules
+
+def words(rules):
+    return sum(len(t) + len(p) for t, p in rules)
+
+#------------------------------------------------------------------------------#
+
+class CompressRules(unittest.TestCase):
+
+    def check(self, rules):
+        for nested in (False, True):
+            compressed = compress_rules(rules, nested)
+            self.assertEqual(expand_rules(compressed), expand_rules(rules))
+            self.assertLessEqual(words(compressed), words(rules))
+            if not nested:
+                # without nesting, each target has a single rule
+                targets = [ t for ts, ps in compressed for t in ts ]
+                self.assertEqual(len(targets), len(set(targets)))
+        return compress_rules(rules, True)
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for i in range(200):
+            self.check(random_rules(rnd, rnd.randint(0, 30)))
+
+    def test_shared(self):
+        rules = [ (['a.o'], ['x.o', 'y.o']), (['b.o'], ['x.o', 'y.o']),
+            (['c.o'], ['x.o', 'y.o', 'z.o']), (['d.o'], ['x.o', 'y.o', 'w.o']) ]
+        self.assertEqual(self.check(rules), [
+            ({'a.o', 'b.o', 'c.o', 'd.o'}, {'x.o', 'y.o'}), ({'c.o'}, {'z.o'}),
+            ({'d.o'}, {'w.o'}) ])
+
+    def test_tree(self):
+        with TemporaryDirectory(prefix = 'fortdep-test-') as tmp:
+            generate(tmp, files = 300, programs = 20)
+            graph = DependencyGraph(log = StringIO())
+            cwd = getcwd()
+            chdir(tmp)
+            try:
+                graph.add_paths()
+            finally:
+                chdir(cwd)
+        self.assertEqual(len(graph.programs()), 20)
+        rules = [ ((obj,), deps) for obj, deps in graph.object_dependencies().items() ]
+        self.check(rules)
+        links = [ ((p.objfile.fnexe,), graph.link_objects(p)) for p in graph.programs() ]
+        self.check(links)
+
+    def test_verify(self):
+        # a compressor losing a dependency is caught
+        expand = fortdep2.expand_rules
+        calls = list()
+        def lossy(rules):
+            pairs = expand(rules)
+            calls.append(rules)
+            return set(sorted(pairs)[1:]) if len(calls) == 1 else pairs
+        fortdep2.expand_rules = lossy
+        try:
+            with self.assertRaises(Exception):
+                compress_rules([ (['a.o'], ['x.o', 'y.o']), (['b.o'], ['x.o']) ])
+        finally:
+            fortdep2.expand_rules = expand
+
+#------------------------------------------------------------------------------#
+
+def fold_by_character(s, lc = '\\', lw = 80):
+    """fold of the first version of fortdep, as a reference"""
+    o = list()
+    buf_line = u""
+    buf_word = u""
+    for c in s + ' ':
+        if c.isspace():
+            if len(buf_line) + len(buf_word) + len(lc) >= lw:
+                buf_line = buf_line + " " * (lw - len(buf_line) - len(lc)) + lc
+                o.append(buf_line)
+                buf_line = u"    "
+            buf_line += buf_word
+            buf_line += c
+            buf_word = u""
+        else:
+            buf_word += c
+    o.append(buf_line + buf_word)
+    return "\n".join(o)
+
+class Fold(unittest.TestCase):
+
+    def random_words(self, rnd):
+        return [ ''.join(rnd.choice('abc./_') for i in range(rnd.choice([1, 3, 8, 20, 90])))
+            for j in range(rnd.randint(0, 60)) ]
+
+    def test_fold(self):
+        rnd = random.Random(1)
+        for i in range(1000):
+            words = self.random_words(rnd)
+            text = ''.join(w + rnd.choice([' ', ' ', '  ', '\t', '\n']) for w in words)
+            width, cont = rnd.choice([10, 40, 80]), rnd.choice(['\\', ' &'])
+            self.assertEqual(fold(text, cont, width), fold_by_character(text, cont, width))
+
+    def test_words(self):
+        rnd = random.Random(2)
+        for i in range(1000):
+            words = self.random_words(rnd) or [ 'a' ]
+            width = rnd.choice([10, 40, 80])
+            buf = StringIO()
+            out = FoldWriter(buf, width, bufsize = rnd.choice([1, 1 << 16]))
+            out.words(iter(words))
+            out.flush()
+            self.assertEqual(buf.getvalue(),
+                fold_by_character(' '.join(words), '\\', width).rstrip(' ') + '\n')
+
+    def test_no_folding(self):
+        buf = StringIO()
+        out = FoldWriter(buf, 0)
+        out.rule([ 'prog' ], [ 'a' * 100 ] * 100)
+        out.flush()
+        self.assertEqual(buf.getvalue(), 'prog: ' + ' '.join([ 'a' * 100 ] * 100) + '\n')
+
+if __name__ == '__main__':
+    unittest.main()
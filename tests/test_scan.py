@@ -0,0 +1,141 @@
+# coding: utf-8
+"""
+Scanning sources: the same output from any number of processes, and the
+cache of scan results, kept until the file, its content or the options of
+the scan change. Run with: python -m unittest discover tests
+"""
+
+from os import path, utime
+from shutil import copytree, ignore_patterns
+from tempfile import TemporaryDirectory
+from subprocess import run, PIPE
+import json
+import re
+import unittest
+import sys
+
+here = path.dirname(path.abspath(__file__))
+root = path.dirname(here)
+script = path.join(root, 'fortdep2.py')
+sys.path.insert(0, root)
+from bench.generate import generate
+
+def fortdep2(cwd, *argv):
+    return run([sys.executable, script] + list(argv), cwd = cwd,
+        stdout = PIPE, stderr = PIPE, universal_newlines = True)
+
+#------------------------------------------------------------------------------#
+
+class Parallel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        cls.tree = path.join(cls.tmp.name, 'tree')
+        generate(cls.tree, files = 300, programs = 5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def check(self, cwd, *argv):
+        serial = fortdep2(cwd, '--no-cache', '-j', '1', *argv)
+        self.assertEqual(serial.returncode, 0, serial.stderr)
+        for jobs in ('2', '4', '0'):
+            parallel = fortdep2(cwd, '--no-cache', '-j', jobs, *argv)
+            self.assertEqual((parallel.returncode, parallel.stdout, parallel.stderr),
+                (serial.returncode, serial.stdout, serial.stderr), 'with -j ' + jobs)
+
+    def test_example(self):
+        self.check(path.join(here, 'example'), '-p', '.')
+
+    def test_tree(self):
+        self.check(self.tree, '-p', '--interfaces', '.')
+        self.check(self.tree, '--format', 'json', '.')
+
+    def test_duplicate_module(self):
+        with TemporaryDirectory(prefix = 'fortdep-test-') as tmp:
+            copytree(path.join(here, 'example'), path.join(tmp, 'example'),
+                ignore = ignore_patterns('.fortdep*'))
+            with open(path.join(tmp, 'example', 'copy.f90'), 'w') as f:
+                f.write('module m2\nend module\n')
+            serial = fortdep2(path.join(tmp, 'example'), '--no-cache', '-j', '1', '.')
+            parallel = fortdep2(path.join(tmp, 'example'), '--no-cache', '-j', '4', '.')
+            self.assertNotEqual(serial.returncode, 0)
+            self.assertIn('m2', serial.stderr)
+            self.assertEqual((parallel.returncode, parallel.stderr),
+                (serial.returncode, serial.stderr))
+
+#------------------------------------------------------------------------------#
+
+class Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        self.work = path.join(self.tmp.name, 'example')
+        copytree(path.join(here, 'example'), self.work,
+            ignore = ignore_patterns('.fortdep*'))
+        self.cache = path.join(self.work, '.fortdep-cache')
+        # files changed within the last seconds are always read again
+        self.sources = [ path.join(self.work, fn) for fn in ('i1.f90', 'i2.f90',
+            'm1.f90', 'm11.f90', 'm2.f90', 'm3.f90', 'prog1.f90', 'prog2.f90') ]
+        for fn in self.sources: utime(fn, (1e9, 1e9))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_scanned(self, *argv):
+        """number of files scanned and the output of a run"""
+        p = fortdep2(self.work, '-v', '-p', *(argv + ('.',)))
+        self.assertEqual(p.returncode, 0, p.stderr)
+        return int(re.search(r'(\d+) of \d+ files scanned', p.stderr).group(1)), p.stdout
+
+    def test_unchanged(self):
+        scanned, first = self.run_scanned()
+        self.assertEqual(scanned, 8)
+        self.assertEqual(self.run_scanned(), (0, first))
+        self.assertEqual(self.run_scanned('--no-cache'), (8, first))
+
+    def test_content(self):
+        scanned, first = self.run_scanned()
+        fn = path.join(self.work, 'prog2.f90')
+        # same content, other mtime: read and hashed, same records
+        utime(fn, (1.5e9, 1.5e9))
+        self.assertEqual(self.run_scanned(), (1, first))
+        self.assertEqual(self.run_scanned(), (0, first))
+        with open(fn, 'w') as f:
+            f.write('program prog2\n  use m1\nend program\n')
+        utime(fn, (1.6e9, 1.6e9))
+        scanned, output = self.run_scanned()
+        self.assertEqual(scanned, 1)
+        self.assertIn('prog2.o: m1.o\n', output)
+
+    def test_key(self):
+        self.run_scanned()
+        # options which change the results of scanning drop the cache
+        self.assertEqual(self.run_scanned('--encoding', 'latin-1')[0], 8)
+        self.assertEqual(self.run_scanned('-D', 'X')[0], 8)
+        self.assertEqual(self.run_scanned('-D', 'X')[0], 0)
+        self.assertEqual(self.run_scanned('-D', 'X=2')[0], 8)
+        self.assertEqual(self.run_scanned('-D', 'X=2', '-U', 'Y')[0], 0)
+        self.assertEqual(self.run_scanned()[0], 8)
+        # and so does another version of fortdep
+        with open(self.cache) as f:
+            data = json.load(f)
+        data['key'][0] = 'other'
+        with open(self.cache, 'w') as f:
+            json.dump(data, f)
+        self.assertEqual(self.run_scanned()[0], 8)
+
+    def test_removed(self):
+        self.run_scanned()
+        with open(self.cache) as f:
+            self.assertEqual(len(json.load(f)['files']), 8)
+        from os import remove
+        remove(path.join(self.work, 'prog2.f90'))
+        self.assertEqual(self.run_scanned()[0], 0)
+        with open(self.cache) as f:
+            self.assertEqual(len(json.load(f)['files']), 7)
+
+if __name__ == '__main__':
+    unittest.main()
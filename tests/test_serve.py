@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+Queries to the daemon (fortdep2 serve) and answers, through the socket and
+the client (fortdep2 query). Run with: python -m unittest discover tests
+"""
+
+from os import path, environ
+from shutil import copytree, ignore_patterns
+from tempfile import TemporaryDirectory
+from subprocess import Popen, run, PIPE, DEVNULL
+from time import sleep, monotonic
+import json
+import socket
+import unittest
+import sys
+
+here = path.dirname(path.abspath(__file__))
+script = path.join(path.dirname(here), 'fortdep2.py')
+
+#------------------------------------------------------------------------------#
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are needed')
+class Serve(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory(prefix = 'fortdep-test-')
+        cls.work = path.join(cls.tmp.name, 'example')
+        copytree(path.join(here, 'example'), cls.work,
+            ignore = ignore_patterns('.fortdep*'))
+        cls.server = Popen([sys.executable, script, 'serve', '--no-cache', '.'],
+            cwd = cls.work, stdout = DEVNULL, stderr = DEVNULL)
+        cls.socket = path.join(cls.work, '.fortdep.sock')
+        deadline = monotonic() + 10
+        while not path.exists(cls.socket):
+            if monotonic() > deadline or cls.server.poll() != None:
+                cls.tearDownClass()
+                raise RuntimeError('server did not start')
+            sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        cls.tmp.cleanup()
+
+    def ask(self, request):
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(self.socket)
+            with client.makefile('rwb') as f:
+                f.write(json.dumps(request).encode() + b'\n')
+                f.flush()
+                return json.loads(f.readline())
+
+    def query(self, *argv):
+        return run([sys.executable, script, 'query'] + list(argv),
+            cwd = self.work, stdout = PIPE, stderr = PIPE, universal_newlines = True)
+
+    def test_answers(self):
+        self.assertEqual(self.ask(dict(query = 'module', name = 'M1')), dict(result = 'm1.o'))
+        self.assertIn('error', self.ask(dict(query = 'module', name = 'nothing')))
+        p = self.query('module', 'm1', 'm2')
+        self.assertEqual((p.returncode, p.stdout), (0, 'm1.o\nm2.o\n'))
+
+    def test_without_name(self):
+        self.assertEqual(self.ask(dict(query = 'deps')), dict(error = 'missing name'))
+        self.assertEqual(self.ask([ 'deps' ]), dict(error = 'invalid request'))
+        # the client refuses to send such a query
+        p = self.query('deps')
+        self.assertEqual(p.returncode, 2)
+        self.assertIn('requires a name', p.stderr)
+        self.assertEqual(self.query('ping').returncode, 0)
+
+if __name__ == '__main__':
+    unittest.main()